@@ -0,0 +1,53 @@
+# Copyright 2020 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Open source under the MIT license (see LICENSE)
+
+"""Compare building a Biomization with the vectorized constructor
+against the previous pivot_table implementation.
+
+Run with: python benchmarks/bench_construction.py [--taxas N] [--pfts N] [--biomes N]
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from brioche import Biomization
+
+from synthetic import random_mappings
+
+parser = argparse.ArgumentParser(description='Benchmark Biomization construction')
+parser.add_argument('--taxas', type=int, default=40000)
+parser.add_argument('--pfts', type=int, default=100)
+parser.add_argument('--biomes', type=int, default=30)
+parser.add_argument('--repeat', type=int, default=3)
+
+def pivot_table_constructor(taxas, biomes):
+    mapping = biomes.mapping.merge(taxas.mapping, on='pft', how='outer', sort=False)
+    matrix = mapping.pivot_table(
+        index='taxa', columns='biome', values='pft',
+        aggfunc=lambda v: 1,
+        fill_value=0)
+    return matrix, matrix.sum(axis='index')
+
+def main():
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    taxas, biomes = random_mappings(args.taxas, args.pfts, args.biomes, rng)
+
+    expected, expected_counts = pivot_table_constructor(taxas, biomes)
+    biomization = Biomization(taxas, biomes)
+    pd.testing.assert_frame_equal(biomization.taxa_biome_matrix, expected)
+    pd.testing.assert_series_equal(biomization._taxas_per_biome, expected_counts) # pylint: disable=protected-access
+
+    print('{} taxas, {} PFTs, {} biomes'.format(args.taxas, args.pfts, args.biomes))
+    for name, func in [
+            ('pivot_table', lambda: pivot_table_constructor(taxas, biomes)),
+            ('Biomization', lambda: Biomization(taxas, biomes))]:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print('{:12} {:8.3f} s'.format(name, best))
+
+if __name__ == '__main__':
+    main()
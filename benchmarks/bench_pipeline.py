@@ -0,0 +1,97 @@
+# Copyright 2020 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Open source under the MIT license (see LICENSE)
+
+"""Benchmark each stage of the biomization pipeline and the brioche command line tool
+on synthetic data, reporting the best wall time and the peak traced memory.
+
+Run with: python benchmarks/bench_pipeline.py [--taxas N] [--biomes N] [--depths N] [--sites N] ...
+"""
+
+import os
+import gc
+import io
+import argparse
+import tempfile
+import timeit
+import tracemalloc
+import contextlib
+
+import numpy as np
+
+from brioche import Biomization
+from brioche.tool import main as tool_main
+
+from synthetic import random_mappings, random_sites, write_mapping_csv
+
+parser = argparse.ArgumentParser(description='Benchmark the biomization pipeline')
+parser.add_argument('--taxas', type=int, default=5000, help='Taxas in the mapping')
+parser.add_argument('--pfts', type=int, default=100, help='PFTs in the mapping')
+parser.add_argument('--biomes', type=int, default=30, help='Biomes in the mapping')
+parser.add_argument('--site-taxas', type=int, default=300, help='Taxas in each site')
+parser.add_argument('--depths', type=int, default=2000, help='Samples in each site')
+parser.add_argument('--sites', type=int, default=4, help='Sites for the end-to-end benchmark')
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--seed', type=int, default=0)
+
+def measure(func, repeat):
+    """Return the best wall time in seconds and the peak traced memory in bytes."""
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return best, peak
+
+def report(name, func, repeat):
+    seconds, peak = measure(func, repeat)
+    print('{:24} {:10.4f} s {:10.1f} MiB'.format(name, seconds, peak / 2 ** 20))
+
+def main():
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    taxas, biomes = random_mappings(args.taxas, args.pfts, args.biomes, rng)
+    sites = random_sites(args.sites, args.depths, args.site_taxas, args.taxas, rng)
+    counts = sites[0]
+
+    biomization = Biomization(taxas, biomes)
+    percentages = counts.get_percentages()
+    stabilized = counts.get_stabilized(default_threshold=0.5)
+
+    print('{} taxas, {} PFTs, {} biomes, {} depths x {} taxas per site, {} sites'.format(
+        args.taxas, args.pfts, args.biomes, args.depths, args.site_taxas, args.sites))
+    print('{:24} {:>12} {:>14}'.format('stage', 'time', 'peak memory'))
+
+    report('Biomization', lambda: Biomization(taxas, biomes), args.repeat)
+    report('get_percentages', lambda: counts.get_percentages(), args.repeat)
+    report('get_stabilized', lambda: counts.get_stabilized(default_threshold=0.5), args.repeat)
+    report('get_stabilized (pct)', lambda: percentages.get_stabilized(default_threshold=0.5), args.repeat)
+    report('get_biome_affinity', lambda: biomization.get_biome_affinity(stabilized).biomes, args.repeat)
+    report('get_biome_affinities', lambda: biomization.get_biome_affinities(
+        *[site.get_stabilized(default_threshold=0.5) for site in sites]), args.repeat)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        taxas_path = os.path.join(tmpdir, 'taxas.csv')
+        biomes_path = os.path.join(tmpdir, 'biomes.csv')
+        write_mapping_csv(taxas, taxas_path)
+        write_mapping_csv(biomes, biomes_path)
+
+        site_paths = []
+        for site in sites:
+            path = os.path.join(tmpdir, '{}.csv'.format(site.site))
+            site.samples.to_csv(path)
+            site_paths.append(path)
+
+        def run_tool():
+            with contextlib.redirect_stdout(io.StringIO()):
+                tool_main(['--taxas', taxas_path, '--biomes', biomes_path] + site_paths)
+
+        report('brioche tool', run_tool, args.repeat)
+
+if __name__ == '__main__':
+    main()
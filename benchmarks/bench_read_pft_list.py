@@ -0,0 +1,47 @@
+# Copyright 2020 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Open source under the MIT license (see LICENSE)
+
+"""Compare reading a large ragged PFT list CSV with the vectorized parser
+against the previous row-wise apply implementation.
+
+Run with: python benchmarks/bench_read_pft_list.py [--rows N] [--pfts N]
+"""
+
+import io
+import argparse
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from brioche import TaxaPftList
+
+from synthetic import random_pft_list_csv
+
+parser = argparse.ArgumentParser(description='Benchmark PftListBase.read_csv')
+parser.add_argument('--rows', type=int, default=40000)
+parser.add_argument('--pfts', type=int, default=100)
+parser.add_argument('--max-pfts-per-row', type=int, default=6)
+parser.add_argument('--repeat', type=int, default=3)
+
+def apply_read_csv(csv):
+    raw = pd.read_csv(io.StringIO(csv), dtype=str, header=None)
+    df_list = raw.apply(lambda row: pd.Series([row.iloc[0], row.iloc[1:].dropna().to_list()], index=['taxa', 'pft']), axis='columns')
+    return TaxaPftList(df_list)
+
+def main():
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    csv = random_pft_list_csv(args.rows, args.pfts, args.max_pfts_per_row, rng)
+
+    pd.testing.assert_frame_equal(TaxaPftList.read_csv(io.StringIO(csv)).mapping, apply_read_csv(csv).mapping)
+
+    print('{} rows, up to {} PFTs per row'.format(args.rows, args.max_pfts_per_row))
+    for name, func in [
+            ('apply', lambda: apply_read_csv(csv)),
+            ('vectorized', lambda: TaxaPftList.read_csv(io.StringIO(csv)))]:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print('{:12} {:8.3f} s'.format(name, best))
+
+if __name__ == '__main__':
+    main()
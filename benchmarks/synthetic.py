@@ -0,0 +1,58 @@
+# Copyright 2020 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Open source under the MIT license (see LICENSE)
+
+"""Synthetic mapping tables and pollen samples of configurable size for the benchmarks.
+"""
+
+import numpy as np
+import pandas as pd
+
+from brioche import TaxaPftList, BiomePftList, PollenCounts
+
+def random_pft_list(constructor, key_name, count, pfts, max_pfts, rng):
+    return constructor(pd.DataFrame.from_records(
+        columns=(key_name, 'pft'),
+        data=[('{}{}'.format(key_name, i),
+               [str(p) for p in rng.choice(pfts, size=rng.integers(1, max_pfts + 1), replace=False)])
+              for i in range(count)]))
+
+def random_mappings(taxas, pfts, biomes, rng, max_pfts_per_taxa=3, max_pfts_per_biome=10):
+    """Return a TaxaPftList and BiomePftList with random PFTs."""
+    return (random_pft_list(TaxaPftList, 'taxa', taxas, pfts, max_pfts_per_taxa, rng),
+            random_pft_list(BiomePftList, 'biome', biomes, pfts, max_pfts_per_biome, rng))
+
+def random_pft_list_csv(rows, pfts, max_pfts_per_row, rng, key_name='taxa', sep=','):
+    """Return the contents of a ragged PFT list CSV file."""
+    lines = []
+    for i in range(rows):
+        row_pfts = rng.choice(pfts, size=rng.integers(0, max_pfts_per_row + 1), replace=False)
+        padding = [''] * (max_pfts_per_row - len(row_pfts))
+        lines.append(sep.join(['{}{}'.format(key_name, i)] + [str(p) for p in row_pfts] + padding))
+    return '\n'.join(lines) + '\n'
+
+def random_counts(depths, taxas, rng, site=None, total_taxas=None, max_count=200, zero_fraction=0.7):
+    """Return PollenCounts for a site with a random selection of taxas, 
+    most of which are zero in each sample like in real data.
+    """
+    names = ['taxa{}'.format(i) for i in rng.choice(total_taxas or taxas, size=taxas, replace=False)]
+    counts = rng.integers(0, max_count, size=(depths, taxas))
+    counts[rng.random(size=counts.shape) < zero_fraction] = 0
+
+    return PollenCounts(pd.DataFrame(counts, columns=names,
+                                     index=pd.Index(np.arange(depths) * 10, name='depth')),
+                        site=site)
+
+def random_sites(sites, depths, taxas, total_taxas, rng):
+    return [random_counts(depths, taxas, rng, site='site{}'.format(i), total_taxas=total_taxas)
+            for i in range(sites)]
+
+def write_mapping_csv(mapping, path):
+    """Write a PFT list mapping in the ragged CSV format read by the brioche tool."""
+    key_name = mapping.mapping.columns[0]
+    pfts = mapping.mapping.dropna().groupby(key_name, sort=False)['pft'].agg(list)
+    width = pfts.map(len).max()
+
+    # Pad all rows to the same number of fields so the CSV parser accepts them
+    with open(path, 'wt') as f:
+        for key, key_pfts in pfts.items():
+            f.write(','.join([key] + key_pfts + [''] * (width - len(key_pfts))) + '\n')
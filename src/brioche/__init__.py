@@ -13,6 +13,11 @@ from .mappings import MappingBase, \
     BiomePftMatrix, TaxaPftMatrix, \
     BiomePftList, TaxaPftList
 
-from .samples import PollenSamples, PollenCounts, PollenPercentages, StabilizedPollenSamples
+from .samples import PollenSamples, PollenCounts, PollenPercentages, StabilizedPollenSamples, \
+    read_thresholds_csv, stabilize_percentages
 
-from .biomization import Biomization, BiomeAffinity
+from .biomization import Biomization, BiomeAffinity, SparseTaxaBiomeMatrix
+
+from .chunked import biomize_csv_in_chunks
+
+from .instrumentation import Profile, recording, set_recorder
@@ -4,41 +4,406 @@
 # pylint: disable=import-error
 
 import math
+from collections import namedtuple
+import numpy as np
 import pandas as pd
 
+from .instrumentation import stage
+from .samples import PollenCounts, get_threshold_row, stabilize_percentages
+
+SAVE_FORMAT_VERSION = 1
+
+# Number of sample column layouts to keep the taxa matrix alignment for
+ALIGNMENT_CACHE_SIZE = 128
+
+# The positions of the mapped sample columns, the corresponding positions 
+# and dense rows in the taxa matrix, the rows converted to the sample value
+# types by dtype, and the unmapped sample columns
+ColumnAlignment = namedtuple('ColumnAlignment', ['sample_positions', 'taxa_positions', 'matrix', 'matrices', 'unmapped_taxas'])
+
+# The taxa/biome relationships added and removed between two biomizations,
+# and the taxas and biomes that are part of any of them
+MappingChanges = namedtuple('MappingChanges', ['added', 'removed', 'taxas', 'biomes'])
+
 class Biomization:
     def __init__(self, pft_taxas, pft_biomes):
-        # Join the mappings on PFTs to get relationships between taxas and biomes
-        self._taxa_biome_mapping = pft_biomes.mapping.merge(
-            pft_taxas.mapping, on='pft', how='outer', sort=False)
+        with stage('build_biomization'):
+            # Join the mappings on PFTs to get relationships between taxas and biomes
+            self._taxa_biome_mapping = pft_biomes.mapping.merge(
+                pft_taxas.mapping, on='pft', how='outer', sort=False)
 
-        # Turn the relationships back into a matrix indexed by taxa with one column per biome
-        self._taxa_biome_matrix = self._taxa_biome_mapping.pivot_table(
-            index='taxa', columns='biome', values='pft',
-            aggfunc=lambda v: 1,
-            fill_value=0)
+            # Turn the relationships back into a matrix indexed by taxa with one column per biome.
+            # Only the mapped relationships are kept, the dense matrix is recreated if requested.
+            self._set_taxa_biome_sparse_matrix(SparseTaxaBiomeMatrix.from_mapping(self._taxa_biome_mapping))
+
+    def _set_taxa_biome_sparse_matrix(self, sparse_matrix, taxas_per_biome=None):
+        self._taxa_biome_sparse_matrix = sparse_matrix
+        self._taxa_biome_matrix = None
+        self._alignments = {}
 
         # Count the mapped taxas per biome to calculate specificity adjustments below
-        self._taxas_per_biome = self._taxa_biome_matrix.sum(axis='index')
+        if taxas_per_biome is None:
+            taxas_per_biome = sparse_matrix.get_taxas_per_biome()
+        self._taxas_per_biome = taxas_per_biome
         self._specificity_decimals = int(math.log10(self._taxas_per_biome.max())) + 1
 
+    def save(self, file):
+        """Save the taxa/biome matrix to a compressed NumPy file, which can be loaded 
+        with Biomization.load() much faster than rebuilding it from the mappings.
+        The taxa and biome names are stored as strings, and the joined 
+        taxa_biome_mapping is not saved.
+        """
+        sparse = self._taxa_biome_sparse_matrix
+        np.savez_compressed(file,
+                            version=np.array(SAVE_FORMAT_VERSION),
+                            taxas=sparse.taxas.to_numpy(dtype=str),
+                            biomes=sparse.biomes.to_numpy(dtype=str),
+                            indptr=sparse.indptr,
+                            indices=sparse.indices,
+                            taxas_per_biome=self._taxas_per_biome.to_numpy())
+
+    @classmethod
+    def load(cls, file):
+        """Load a Biomization saved with save().  The taxa_biome_mapping 
+        of the loaded object is None.
+        """
+        with np.load(file, allow_pickle=False) as data:
+            if data['version'] != SAVE_FORMAT_VERSION:
+                raise ValueError('Unsupported biomization file version: {}'.format(data['version']))
+
+            taxas = pd.Index(data['taxas'], dtype=object, name='taxa')
+            biomes = pd.Index(data['biomes'], dtype=object, name='biome')
+            sparse = SparseTaxaBiomeMatrix(taxas, biomes, data['indptr'], data['indices'])
+            taxas_per_biome = pd.Series(data['taxas_per_biome'], index=biomes)
+
+        biomization = cls.__new__(cls)
+        biomization._taxa_biome_mapping = None # pylint: disable=protected-access
+        biomization._set_taxa_biome_sparse_matrix(sparse, taxas_per_biome) # pylint: disable=protected-access
+        return biomization
+
     @property
     def taxa_biome_mapping(self): return self._taxa_biome_mapping
 
     @property
-    def taxa_biome_matrix(self): return self._taxa_biome_matrix
+    def taxa_biome_matrix(self):
+        if self._taxa_biome_matrix is None:
+            self._taxa_biome_matrix = self._taxa_biome_sparse_matrix.to_dataframe()
+        return self._taxa_biome_matrix
+
+    @property
+    def taxa_biome_sparse_matrix(self): return self._taxa_biome_sparse_matrix
 
     def get_unmapped_taxas(self, *sites):
         return {
             taxa
             for site in sites
-            for taxa in site.samples
-            if taxa not in self._taxa_biome_matrix.index
+            for taxa in self._get_alignment(site.samples.columns).unmapped_taxas
         }
 
-    def get_biome_affinity(self, stabilized_samples):
+    def get_biome_affinity(self, stabilized_samples, engine='matmul'):
+        samples = stabilized_samples.samples
+
+        with stage('get_biome_affinity', site=stabilized_samples.site, frame=samples):
+            if engine == 'matmul':
+                affinity_scores = self._get_affinity_scores_by_matmul(samples)
+            elif engine == 'loop':
+                affinity_scores = self._get_affinity_scores_by_loop(samples)
+            else:
+                raise ValueError('Unknown affinity engine: {}'.format(engine))
+
+        return BiomeAffinity(affinity_scores, self._get_specificity_scores(stabilized_samples.decimals),
+                             stabilized_samples.site, stabilized_samples.decimals)
+
+    def get_biome_affinities(self, *sites, combined=False):
+        """Calculate the biome affinity for many sites of stabilized samples at once.
+
+        The sample columns are aligned once over the union of taxas in all sites
+        and all scores are calculated in a single pass.  A list of BiomeAffinity
+        objects is returned, one per site, unless combined is True in which case
+        a single BiomeAffinity is returned with the site as the first index level.
+        """
+        if combined:
+            decimals = {site.decimals for site in sites}
+            if len(decimals) != 1:
+                raise ValueError('All sites must use the same decimals to combine them')
+
+            with stage('get_biome_affinities') as info:
+                samples = info['frame'] = pd.concat([site.samples for site in sites],
+                                                    keys=[site.site for site in sites], names=['site'])
+                affinity_scores = self._get_affinity_scores_by_matmul(samples)
+
+            decimals = decimals.pop()
+            return BiomeAffinity(affinity_scores, self._get_specificity_scores(decimals), None, decimals)
+
+        if not sites:
+            return []
+
+        with stage('get_biome_affinities') as info:
+            samples = info['frame'] = pd.concat([site.samples for site in sites], ignore_index=True)
+            scores = self._get_affinity_scores_by_matmul(samples).to_numpy()
+
+        affinities = []
+        start = 0
+        for site in sites:
+            end = start + len(site.samples.index)
+            affinity_scores = pd.DataFrame(scores[start:end], index=site.samples.index,
+                                           columns=self._taxa_biome_sparse_matrix.biomes.rename(None))
+            affinities.append(BiomeAffinity(affinity_scores, self._get_specificity_scores(site.decimals),
+                                            site.site, site.decimals))
+            start = end
+
+        return affinities
+
+    def get_bootstrap_biomes(self, counts, replicates=1000, default_threshold=0.0, decimals=2,
+                             thresholds=None, seed=None, batch_size=100):
+        """Estimate how certain the biome of each sample is by resampling the pollen counts.
+
+        Each replicate draws as many pollen grains as were counted in the sample
+        from a multinomial distribution with the sample proportions, and is then
+        stabilized and scored like get_stabilized() and get_biome_affinity() do.
+        The replicates are drawn and scored batch_size at a time as 3-D arrays.
+        seed is passed to numpy.random.default_rng() to make the draws reproducible.
+
+        Returns a data frame with the same index as the counts and the fraction
+        of the replicates that got each biome, including N/A, as columns.
+        """
+        if not isinstance(counts, PollenCounts):
+            raise ValueError('Bootstrapping requires pollen counts')
+        if replicates < 1:
+            raise ValueError('At least one replicate is required')
+
+        samples = counts.samples
+
+        with stage('get_bootstrap_biomes', site=counts.site, frame=samples):
+            values = np.nan_to_num(samples.to_numpy(dtype=np.float64))
+            sums = values.sum(axis=1, keepdims=True)
+            proportions = np.divide(values, sums, out=np.zeros_like(values), where=sums != 0)
+            totals = np.rint(sums[:, 0]).astype(np.int64)
+
+            # The percentages are relative to all drawn grains, but after that
+            # only the mapped taxas are needed to stabilize and score the replicates
+            alignment = self._get_alignment(samples.columns)
+            threshold = get_threshold_row(samples.columns, default_threshold, thresholds)
+            if np.ndim(threshold):
+                threshold = threshold[alignment.sample_positions]
+
+            matrix = _get_aligned_matrix(alignment, np.float64)
+            specificity = self._get_specificity_scores(decimals).to_numpy(dtype=np.float64)
+            biome_count = matrix.shape[1]
+
+            row_offsets = np.arange(len(samples.index)) * (biome_count + 1)
+            frequencies = np.zeros(len(samples.index) * (biome_count + 1), dtype=np.int64)
+            rng = np.random.default_rng(seed)
+
+            for start in range(0, replicates, batch_size):
+                size = min(batch_size, replicates - start)
+
+                # Replicates x samples x taxas
+                draws = rng.multinomial(totals, proportions, size=(size, len(totals)))
+
+                percentages = draws[:, :, alignment.sample_positions].astype(np.float64)
+                percentages *= 100
+                np.divide(percentages, sums, out=percentages, where=sums != 0)
+                stabilize_percentages(percentages, threshold, decimals, out=percentages)
+
+                scores = percentages @ matrix
+                codes = _get_biome_codes(scores, _adjust_scores(scores, specificity))
+
+                # Count the biome of every replicate per sample
+                frequencies += np.bincount((codes + row_offsets).ravel(), minlength=len(frequencies))
+
+        return pd.DataFrame(frequencies.reshape(len(samples.index), biome_count + 1) / replicates,
+                            index=samples.index,
+                            columns=list(self._taxa_biome_sparse_matrix.biomes) + ['N/A'])
+
+    def get_leave_one_out_biomes(self, stabilized_samples, by='taxa'):
+        """Find the biomes the samples would get if each taxa (by='taxa') or PFT
+        (by='pft') in turn was left out of the mappings, to see how sensitive
+        the biomes are to single taxa or PFT assignments.
+
+        Instead of rebuilding the biomization for every taxa or PFT, the affinity
+        scores are only reduced by the relationships that disappear, and the 
+        specificity scores are recalculated from the reduced taxa counts.
+        Taxas or PFTs that only affect taxas not in the samples can only
+        change the tie-breaker, so they are calculated once per set of biomes.
+
+        Returns a data frame with the same index as the samples and one column
+        of categorical biomes per mapped taxa or PFT.  Leaving out PFTs requires
+        the taxa_biome_mapping, which a loaded biomization doesn't have.
+        """
+        sparse = self._taxa_biome_sparse_matrix
+
+        if by == 'taxa':
+            names = sparse.taxas
+            exclusions = [(np.full(end - start, i), sparse.indices[start:end])
+                          for i, (start, end) in enumerate(zip(sparse.indptr[:-1], sparse.indptr[1:]))]
+        elif by == 'pft':
+            names, exclusions = self._get_pft_exclusions()
+        else:
+            raise ValueError('Unknown mapping to leave out: {}'.format(by))
+
         samples = stabilized_samples.samples
+        decimals = stabilized_samples.decimals
+
+        with stage('get_leave_one_out_biomes', site=stabilized_samples.site, frame=samples):
+            alignment = self._get_alignment(samples.columns)
+            values = _get_aligned_values(samples, alignment)
+            scores = values @ _get_aligned_matrix(alignment, np.float64)
+
+            # Map matrix rows to the aligned sample columns, or -1 for taxas not in the samples
+            sample_columns = np.full(len(sparse.taxas), -1, dtype=np.int64)
+            sample_columns[alignment.taxa_positions] = np.arange(len(alignment.taxa_positions))
+
+            taxas_per_biome = self._taxas_per_biome.to_numpy()
+            categories = list(sparse.biomes) + ['N/A']
+            unchanged_scores = {}
+            biomes = {}
+
+            for name, (removed_taxas, removed_biomes) in zip(names, exclusions):
+                columns = sample_columns[removed_taxas]
+                in_samples = columns >= 0
+                key = tuple(np.sort(removed_biomes))
+
+                if not in_samples.any() and key in unchanged_scores:
+                    biomes[name] = unchanged_scores[key]
+                    continue
+
+                reduced_scores = scores.copy()
+                np.subtract.at(reduced_scores, (slice(None), removed_biomes[in_samples]), values[:, columns[in_samples]])
+
+                reduced_taxas_per_biome = taxas_per_biome - np.bincount(removed_biomes, minlength=len(taxas_per_biome))
+                specificity_decimals = int(math.log10(max(reduced_taxas_per_biome.max(), 1))) + 1
+                specificity = reduced_taxas_per_biome * 10.0 ** -(decimals + specificity_decimals)
+
+                codes = _get_biome_codes(reduced_scores, _adjust_scores(reduced_scores, specificity))
+                biomes[name] = pd.Categorical.from_codes(codes, categories=categories)
+
+                if not in_samples.any():
+                    unchanged_scores[key] = biomes[name]
+
+        return pd.DataFrame(biomes, index=samples.index, columns=names)
+
+    def _get_pft_exclusions(self):
+        # Taxas can map to a biome through several PFTs, so leaving out a PFT only
+        # removes the relationships that no other PFT provides
+        if self._taxa_biome_mapping is None:
+            raise ValueError('Leaving out PFTs requires the taxa_biome_mapping')
 
+        sparse = self._taxa_biome_sparse_matrix
+        mapping = self._taxa_biome_mapping.dropna(subset=['pft'])
+        relationships = mapping.dropna(subset=['taxa', 'biome']).drop_duplicates(['pft', 'taxa', 'biome'])
+
+        taxa_positions = sparse.taxas.get_indexer(relationships['taxa'])
+        biome_positions = sparse.biomes.get_indexer(relationships['biome'])
+        pair_keys = taxa_positions * max(len(sparse.biomes), 1) + biome_positions
+        unique = pd.Series(pair_keys).map(pd.Series(pair_keys).value_counts()).to_numpy() == 1
+
+        names = pd.Index(pd.unique(mapping['pft']), name='pft')
+        removed = pd.Series(np.arange(len(relationships))[unique]).groupby(
+            relationships['pft'].to_numpy()[unique]).indices
+        exclusions = [(taxa_positions[unique][removed.get(pft, [])], biome_positions[unique][removed.get(pft, [])])
+                      for pft in names]
+
+        return names, exclusions
+
+    def get_mapping_changes(self, previous):
+        """Compare with the previous version of the biomization, e.g. built from
+        an earlier version of the taxa or biome PFT lists, and return the 
+        taxa/biome relationships that have been added or removed.
+        """
+        old = previous.taxa_biome_sparse_matrix.get_relationships()
+        new = self._taxa_biome_sparse_matrix.get_relationships()
+
+        added = new.difference(old, sort=True)
+        removed = old.difference(new, sort=True)
+        changed = added.append(removed)
+
+        return MappingChanges(added=added.to_frame(index=False),
+                              removed=removed.to_frame(index=False),
+                              taxas=changed.get_level_values('taxa').unique(),
+                              biomes=changed.get_level_values('biome').unique())
+
+    def update_biome_affinity(self, stabilized_samples, scores, changes):
+        """Update the affinity scores calculated for the samples with a previous
+        biomization to this one, given the changes from get_mapping_changes().
+
+        Only the biomes in the changes are rescored, and only if the samples
+        contain any of the changed taxas.  The scores for the other biomes are
+        reused, and the specificity scores always come from this biomization.
+        """
+        samples = stabilized_samples.samples
+        if not scores.index.equals(samples.index):
+            raise ValueError('The scores must have the same index as the samples')
+
+        biomes = self._taxa_biome_sparse_matrix.biomes.rename(None)
+
+        # Biomes that are new in this biomization but not mapped by
+        # any sample taxa get a zero score without calculating it
+        affinity_scores = scores.reindex(columns=biomes, fill_value=0.0).astype(np.float64)
+
+        if changes.taxas.isin(samples.columns).any():
+            with stage('update_biome_affinity', site=stabilized_samples.site, frame=samples):
+                positions = biomes.get_indexer(changes.biomes)
+                positions = positions[positions >= 0]
+
+                alignment = self._get_alignment(samples.columns)
+                values = _get_aligned_values(samples, alignment)
+                matrix = _get_aligned_matrix(alignment, np.float64)[:, positions]
+                affinity_scores.iloc[:, positions] = values @ matrix
+
+        return BiomeAffinity(affinity_scores, self._get_specificity_scores(stabilized_samples.decimals),
+                             stabilized_samples.site, stabilized_samples.decimals)
+
+    def _get_specificity_scores(self, decimals):
+        # Calculate a specificity score for the biomes, which will be deducted 
+        # from the affinity scores as a tie-breaker in favour of the least specific
+        # biome.  This is expressed as a fractional number below the number of decimals 
+        # used in the samples.
+        decimals = decimals + self._specificity_decimals
+        return self._taxas_per_biome * 10.0 ** -decimals
+
+    def _get_affinity_scores_by_matmul(self, samples):
+        # Look up the position of each sample taxa in the matrix once, 
+        # dropping the unmapped ones, so the affinity scores for all biomes
+        # can be calculated with a single matrix multiplication of the
+        # stabilized sample values with the 1s and 0s from the mapping.
+        # Only the matrix rows for the sample taxas are expanded to a dense array.
+        alignment = self._get_alignment(samples.columns)
+        values = _get_aligned_values(samples, alignment)
+
+        matrix = _get_aligned_matrix(alignment, np.float64)
+
+        return pd.DataFrame(values @ matrix, index=samples.index,
+                            columns=self._taxa_biome_sparse_matrix.biomes.rename(None))
+
+    def _get_alignment(self, columns):
+        # Sites from the same source often have the same columns, so cache
+        # the label lookups by the column layout
+        key = tuple(columns)
+        alignment = self._alignments.pop(key, None)
+
+        if alignment is None:
+            sparse = self._taxa_biome_sparse_matrix
+            taxa_positions = sparse.taxas.get_indexer(columns)
+            mapped = taxa_positions >= 0
+
+            alignment = ColumnAlignment(
+                sample_positions=np.flatnonzero(mapped),
+                taxa_positions=taxa_positions[mapped],
+                matrix=sparse.get_dense_rows(taxa_positions[mapped]),
+                matrices={},
+                unmapped_taxas=frozenset(columns[~mapped]))
+
+            if len(self._alignments) >= ALIGNMENT_CACHE_SIZE:
+                # Drop the least recently used layout
+                del self._alignments[next(iter(self._alignments))]
+
+        # The layouts are kept in the order they were last used
+        self._alignments[key] = alignment
+
+        return alignment
+
+    def _get_affinity_scores_by_loop(self, samples):
         # Build up a data frame for the affinity scores by starting
         # with an empty one using the same index as the samples
         # (which is probably sample depth), then calculate an 
@@ -48,19 +413,115 @@ class Biomization:
         # Calculate an affinity score for the biome by multiplying the stablized sample values
         # with the 1s and 0s from the mapping, i.e. filtering out taxas that aren't mapped
         # and summing the remaining ones.  
-        for biome in self._taxa_biome_matrix:
-            affinity_scores[biome] = samples.mul(self._taxa_biome_matrix[biome], axis='columns').sum(axis='columns')
+        taxa_biome_matrix = self.taxa_biome_matrix
+        for biome in taxa_biome_matrix:
+            affinity_scores[biome] = samples.mul(taxa_biome_matrix[biome], axis='columns').sum(axis='columns')
 
-        # Also calculate a specificity score for the biomes, which will be deducted 
-        # from the affinity scores as a tie-breaker in favour of the least specific
-        # biome.  This is expressed as a fractional number below the number of decimals 
-        # used in the samples.
-        decimals = stabilized_samples.decimals + self._specificity_decimals
-        specificity_scores = pd.Series([self._taxas_per_biome[biome] * 10 ** -decimals
-                                        for biome in self._taxa_biome_matrix],
-                                        index=self._taxa_biome_matrix.columns)
+        return affinity_scores
+
+def _get_aligned_matrix(alignment, dtype):
+    # Convert the aligned rows once per value type, instead of on every use
+    dtype = np.dtype(dtype)
+    matrix = alignment.matrices.get(dtype)
+    if matrix is None:
+        matrix = alignment.matrices[dtype] = alignment.matrix.astype(dtype)
+    return matrix
+
+
+def _get_aligned_values(samples, alignment):
+    # Scores are always calculated as float64, also for integer or compact float32
+    # samples, since float32 rounding errors in the scores can be larger than
+    # the specificity tie-breaker for biomes with many taxas
+    values = samples.to_numpy()[:, alignment.sample_positions].astype(np.float64, copy=False)
+
+    # Missing sample values are skipped, just like sum() does
+    return np.nan_to_num(values)
+
+
+class SparseTaxaBiomeMatrix:
+    """The relationships between taxas and biomes in compressed sparse row form,
+    so memory use scales with the number of mapped relationships rather than
+    with taxas times biomes.  The biomes mapped by the taxa at position i
+    are at the positions indices[indptr[i]:indptr[i + 1]].
+    """
+
+    def __init__(self, taxas, biomes, indptr, indices):
+        self._taxas = taxas
+        self._biomes = biomes
+        self._indptr = indptr
+        self._indices = indices
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        """Build the matrix from a taxa_biome_mapping, i.e. a data frame with
+        one row per relationship between a taxa and a biome.
+        """
+        mapping = mapping.dropna(subset=['taxa', 'biome'])
+        taxa_codes, taxas = pd.factorize(mapping['taxa'], sort=True)
+        biome_codes, biomes = pd.factorize(mapping['biome'], sort=True)
+
+        # Taxas can map to the same biome through several PFTs, so drop duplicate
+        # relationships.  This also sorts them by taxa and then biome.
+        biome_count = max(len(biomes), 1)
+        relationships = np.unique(taxa_codes.astype(np.int64) * biome_count + biome_codes)
+        rows, columns = np.divmod(relationships, biome_count)
+
+        return cls(pd.Index(taxas, name='taxa'), pd.Index(biomes, name='biome'),
+                   _rows_to_indptr(rows, len(taxas)), columns)
+
+    @classmethod
+    def from_dataframe(cls, matrix):
+        rows, columns = np.nonzero(matrix.to_numpy())
+        return cls(matrix.index, matrix.columns,
+                   _rows_to_indptr(rows, len(matrix.index)), columns.astype(np.int64))
+
+    @property
+    def taxas(self): return self._taxas
+
+    @property
+    def biomes(self): return self._biomes
+
+    @property
+    def indptr(self): return self._indptr
+
+    @property
+    def indices(self): return self._indices
+
+    @property
+    def shape(self): return (len(self._taxas), len(self._biomes))
+
+    def get_taxas_per_biome(self):
+        return pd.Series(np.bincount(self._indices, minlength=len(self._biomes)), index=self._biomes)
+
+    def get_relationships(self):
+        """Return the mapped taxa and biome pairs as a MultiIndex."""
+        taxas = np.repeat(np.arange(len(self._taxas)), np.diff(self._indptr))
+        return pd.MultiIndex.from_arrays([self._taxas[taxas], self._biomes[self._indices]],
+                                         names=['taxa', 'biome'])
+
+    def get_dense_rows(self, taxa_positions):
+        """Return a dense 0/1 array with the matrix rows for the taxas at the given positions."""
+        taxa_positions = np.asarray(taxa_positions, dtype=np.int64)
+        starts = self._indptr[taxa_positions]
+        counts = self._indptr[taxa_positions + 1] - starts
+
+        # Find the position in indices of every relationship for the requested rows
+        offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+
+        rows = np.zeros((len(taxa_positions), len(self._biomes)), dtype=np.int64)
+        rows[np.repeat(np.arange(len(taxa_positions)), counts), self._indices[offsets]] = 1
+        return rows
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.get_dense_rows(np.arange(len(self._taxas))),
+                            index=self._taxas, columns=self._biomes)
+
+
+def _rows_to_indptr(rows, row_count):
+    indptr = np.zeros(row_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=row_count), out=indptr[1:])
+    return indptr
 
-        return BiomeAffinity(affinity_scores, specificity_scores, stabilized_samples.site, stabilized_samples.decimals)
 
 class BiomeAffinity:
     def __init__(self, affinity_scores, specificity_scores, site, decimals):
@@ -69,20 +530,15 @@ class BiomeAffinity:
         self._site = site
         self._decimals = decimals
 
-        # Deduct the specificity scores to give biomes with more mapped taxas a slightly
-        # lower score than the ones with fewer, to break any ties between them.
-        scores = affinity_scores.sub(specificity_scores)
-
-        # For each row find the column with the highest value, i.e. the biome with the highest affinity score
-        self._biomes = scores.idxmax(axis='columns')
-        self._biomes.name = 'Biome'
-
-        # Remove rows where there are no values
-        score_sums = affinity_scores.sum(axis=1)
-        self._biomes[score_sums == 0] = 'N/A'
+        # The biomes are only calculated when requested
+        self._biomes = None
 
     @property
-    def biomes(self): return self._biomes
+    def biomes(self):
+        if self._biomes is None:
+            with stage('get_biomes', site=self._site, frame=self._affinity_scores):
+                self._biomes = get_biomes(self._affinity_scores, self._specificity_scores)
+        return self._biomes
 
     @property
     def scores(self): return self._affinity_scores
@@ -91,11 +547,110 @@ class BiomeAffinity:
     def site(self): return self._site
 
     def apply(self, score_func):
-        new_scores = score_func(self._affinity_scores).round(self._decimals)
+        """Return a new BiomeAffinity with the scores transformed by score_func.
+        score_func can also be a sequence of functions, which are applied in 
+        order without creating intermediate BiomeAffinity objects.
+        """
+        score_funcs = score_func if isinstance(score_func, (list, tuple)) else [score_func]
+
+        new_scores = self._affinity_scores
+        for func in score_funcs:
+            new_scores = func(new_scores).round(self._decimals)
+
         return BiomeAffinity(new_scores, self._specificity_scores, self._site, self._decimals)
 
+    def top_biomes(self, k=3):
+        """Return the k biomes with the highest affinity scores for each row, 
+        ordered in the same way as biomes, in the columns Biome 1, Score 1, 
+        ..., Biome k, Score k.  The Margin column is the difference between 
+        the first and second scores.
+        """
+        biomes = self._affinity_scores.columns
+        values, scores = _get_adjusted_scores(self._affinity_scores, self._specificity_scores)
+
+        # Only partially sort the scores to find the best ones (and always at least two 
+        # to calculate the margin), then fully sort just those
+        count = min(max(k, 2), len(biomes))
+        if count < len(biomes):
+            # Biomes with the same score as the last one to include are picked in column order,
+            # by partitioning on whether the score is better, equal or worse and then the column
+            kth = -np.partition(-scores, count - 1, axis=1)[:, count - 1:count]
+            ranks = np.where(scores > kth, 0, np.where(scores == kth, 1, 2)) * len(biomes) + np.arange(len(biomes))
+            positions = np.argpartition(ranks, count - 1, axis=1)[:, :count]
+        else:
+            positions = np.tile(np.arange(count), (len(scores), 1))
+
+        # Equal scores are ordered by column, so the first biome is the same one argmax picks for biomes
+        order = np.lexsort((positions, -np.take_along_axis(scores, positions, axis=1)), axis=1)
+        positions = np.take_along_axis(positions, order, axis=1)
+        top_values = np.take_along_axis(values, positions, axis=1)
+
+        # Rows without any values get N/A for all biomes, just like for biomes
+        positions[np.nansum(values, axis=1) == 0] = len(biomes)
+        categories = list(biomes) + ['N/A']
+
+        top = pd.DataFrame(index=self._affinity_scores.index)
+        for i in range(min(k, count)):
+            top['Biome {}'.format(i + 1)] = pd.Categorical.from_codes(positions[:, i], categories=categories)
+            top['Score {}'.format(i + 1)] = top_values[:, i]
+
+        top['Margin'] = top_values[:, 0] - top_values[:, 1] if count > 1 else np.nan
+        return top
+
     def biomes_to_csv(self, path_or_buf, **kwargs):
         self.biomes.to_csv(path_or_buf, **kwargs)
 
+    def top_biomes_to_csv(self, path_or_buf, k=3, **kwargs):
+        self.top_biomes(k).to_csv(path_or_buf, float_format='%.{}f'.format(self._decimals), **kwargs)
+
     def scores_to_csv(self, path_or_buf, **kwargs):
         self.scores.to_csv(path_or_buf, float_format='%.{}f'.format(self._decimals), **kwargs)
+
+    def biomes_to_parquet(self, path, **kwargs):
+        self.biomes.to_frame().to_parquet(path, **kwargs)
+
+    def scores_to_parquet(self, path, **kwargs):
+        # Round the scores like the CSV output does, to drop floating point noise
+        self.scores.round(self._decimals).to_parquet(path, **kwargs)
+
+    def top_biomes_to_parquet(self, path, k=3, **kwargs):
+        self.top_biomes(k).round(self._decimals).to_parquet(path, **kwargs)
+
+
+def get_biomes(affinity_scores, specificity_scores):
+    """Find the biome with the highest affinity score for each row, returned
+    as a categorical series with the biomes and N/A for rows without any scores.
+    """
+    biomes = affinity_scores.columns
+    values, scores = _get_adjusted_scores(affinity_scores, specificity_scores)
+    codes = _get_biome_codes(values, scores)
+
+    categories = list(biomes) + ['N/A']
+    return pd.Series(pd.Categorical.from_codes(codes, categories=categories),
+                     index=affinity_scores.index, name='Biome')
+
+
+def _get_adjusted_scores(affinity_scores, specificity_scores):
+    values = affinity_scores.to_numpy(dtype=np.float64)
+    specificity = specificity_scores.reindex(affinity_scores.columns).to_numpy(dtype=np.float64)
+    return values, _adjust_scores(values, specificity)
+
+
+def _adjust_scores(values, specificity):
+    # Deduct the specificity scores to give biomes with more mapped taxas a slightly
+    # lower score than the ones with fewer, to break any ties between them.
+    # Biomes without any specificity score (or with a missing affinity score) are never picked.
+    scores = values - specificity
+    scores[np.isnan(scores)] = -np.inf
+    return scores
+
+
+def _get_biome_codes(values, scores):
+    # For each row find the column with the highest value, i.e. the biome with the highest affinity score.
+    # The biomes are along the last axis, so this works for stacks of score arrays too.
+    biome_count = values.shape[-1]
+    codes = scores.argmax(axis=-1) if biome_count else np.zeros(values.shape[:-1], dtype=np.int64)
+
+    # Rows where there are no values get the extra N/A category
+    codes[np.nansum(values, axis=-1) == 0] = biome_count
+    return codes
@@ -0,0 +1,97 @@
+# Copyright 2020 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Open source under the MIT license (see LICENSE)
+
+"""Biomization of sample files that are too large to read at once.
+"""
+
+# pylint: disable=import-error
+
+import numpy as np
+import pandas as pd
+
+from .samples import StabilizedPollenSamples
+
+def biomize_csv_in_chunks(biomization, sample_class, filepath_or_buffer, chunk_rows,
+                          biomes_path, scores_path,
+                          percentages_path=None, stabilized_path=None,
+                          top_biomes_path=None, top_biomes=3,
+                          default_threshold=0.0, thresholds=None, decimals=2,
+                          site=None, index_col=0, sep=',', **kwargs):
+    """Read a sample CSV file in blocks of chunk_rows rows, calculating percentages,
+    stabilized samples and biome affinity for each block and appending the results
+    to the output CSV files.  Since all steps work on one row at a time the output
+    is the same as when processing the whole file at once.  The file is read twice,
+    first to find the column types for the whole file.
+
+    sample_class is the PollenSamples subclass matching the values in the file.
+    Returns the set of sample taxas that are not mapped to any biome.
+    """
+    unmapped = set()
+    mode = 'w'
+
+    dtype = kwargs.get('dtype')
+    if dtype is None or isinstance(dtype, dict):
+        kwargs['dtype'] = {**_get_column_dtypes(filepath_or_buffer, chunk_rows, sep, **kwargs), **(dtype or {})}
+
+    reader = pd.read_csv(filepath_or_buffer, index_col=index_col, header=0,
+                         sep=sep, chunksize=chunk_rows, **kwargs)
+
+    with reader:
+        for chunk in reader:
+            if issubclass(sample_class, StabilizedPollenSamples):
+                sample = sample_class(chunk, decimals, site=site)
+            else:
+                sample = sample_class(chunk, site=site)
+
+            # Only the first block writes the header, the rest are appended
+            write_kwargs = dict(sep=sep, mode=mode, header=(mode == 'w'))
+
+            unmapped.update(biomization.get_unmapped_taxas(sample))
+
+            stabilized = sample.get_stabilized(default_threshold=default_threshold, decimals=decimals,
+                                               thresholds=thresholds)
+
+            if percentages_path:
+                sample.get_percentages(decimals).to_csv(percentages_path, decimals=decimals, **write_kwargs)
+
+            if stabilized_path:
+                stabilized.to_csv(stabilized_path, **write_kwargs)
+
+            affinity = biomization.get_biome_affinity(stabilized)
+            affinity.biomes_to_csv(biomes_path, **write_kwargs)
+            affinity.scores_to_csv(scores_path, **write_kwargs)
+
+            if top_biomes_path:
+                affinity.top_biomes_to_csv(top_biomes_path, k=top_biomes, **write_kwargs)
+
+            mode = 'a'
+
+    return unmapped
+
+
+def _get_column_dtypes(filepath_or_buffer, chunk_rows, sep, **kwargs):
+    # pandas infers the column types separately for each chunk, so e.g. depths
+    # 10 and 30.5 would be written as 10 and 30.5 instead of 10.0 and 30.5
+    # if they end up in different chunks.  Find the types for the whole file
+    # in a first pass, including the index columns, to read all chunks the same way.
+    kwargs.pop('dtype', None)
+    start = filepath_or_buffer.tell() if hasattr(filepath_or_buffer, 'tell') else None
+
+    dtypes = {}
+    with pd.read_csv(filepath_or_buffer, header=0, sep=sep, chunksize=chunk_rows, **kwargs) as reader:
+        for chunk in reader:
+            for column, dtype in chunk.dtypes.items():
+                dtypes[column] = _get_common_dtype(dtypes.get(column, dtype), dtype)
+
+    if start is not None:
+        filepath_or_buffer.seek(start)
+
+    return dtypes
+
+
+def _get_common_dtype(a, b):
+    if a == b:
+        return a
+    if a.kind in 'iuf' and b.kind in 'iuf':
+        return np.result_type(a, b)
+    return np.dtype(object)
@@ -0,0 +1,118 @@
+# Copyright 2020 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Open source under the MIT license (see LICENSE)
+
+"""Timing and memory instrumentation of the biomization stages.
+
+Install a recorder with set_recorder() or the recording() context manager,
+and the samples, biomization and tool modules report each stage to it.
+Without a recorder the stages are not measured at all.
+"""
+
+import time
+import json
+import tracemalloc
+import contextlib
+
+_recorder = None
+
+# The highest traced memory seen by each active stage in nested stages
+# that have reset the tracemalloc peak, innermost stage last
+_peaks = []
+
+def get_recorder():
+    return _recorder
+
+def set_recorder(recorder):
+    """Install a recorder, i.e. a callable taking a dict for each finished stage,
+    or None to remove it.  Returns the previous recorder.
+    """
+    global _recorder # pylint: disable=global-statement
+    previous = _recorder
+    _recorder = recorder
+    return previous
+
+@contextlib.contextmanager
+def recording(recorder):
+    previous = set_recorder(recorder)
+    try:
+        yield recorder
+    finally:
+        set_recorder(previous)
+
+@contextlib.contextmanager
+def stage(name, site=None, frame=None):
+    """Measure a stage and report it to the recorder, if there is one.
+    The rows and columns processed are taken from the data frame, which 
+    can also be set as 'frame' in the dict yielded by the context manager
+    if it isn't known until the end of the stage.  While tracemalloc is tracing,
+    allocated_bytes is the peak memory used during the stage above the memory
+    used at the start, so temporary buffers are included even if they are freed.
+    """
+    info = dict(frame=frame)
+
+    if _recorder is None:
+        yield info
+        return
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        start_memory, peak_memory = tracemalloc.get_traced_memory()
+
+        # Resetting the peak would lose it for the enclosing stage, so keep it here
+        if _peaks:
+            _peaks[-1] = max(_peaks[-1], peak_memory)
+        _peaks.append(start_memory)
+        tracemalloc.reset_peak()
+
+    start = time.perf_counter()
+    try:
+        yield info
+    finally:
+        wall_time = time.perf_counter() - start
+
+        if tracing:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            peak_memory = max(peak_memory, _peaks.pop())
+            if _peaks:
+                _peaks[-1] = max(_peaks[-1], peak_memory)
+
+    record = dict(stage=name, site=site, wall_time=wall_time)
+
+    if info['frame'] is not None:
+        record['rows'], record['columns'] = info['frame'].shape
+
+    if tracing:
+        record['allocated_bytes'] = peak_memory - start_memory
+
+    _recorder(record)
+
+
+class Profile:
+    """Recorder that collects the stages to write a JSON report."""
+
+    def __init__(self):
+        self._stages = []
+
+    def __call__(self, record):
+        self._stages.append(record)
+
+    @property
+    def stages(self): return self._stages
+
+    def get_totals(self):
+        """Sum the wall time per stage name."""
+        totals = {}
+        for record in self._stages:
+            total = totals.setdefault(record['stage'], dict(count=0, wall_time=0.0))
+            total['count'] += 1
+            total['wall_time'] += record['wall_time']
+        return totals
+
+    def to_json(self, path_or_buf, **kwargs):
+        report = dict(stages=self._stages, totals=self.get_totals())
+
+        if isinstance(path_or_buf, str):
+            with open(path_or_buf, 'wt') as f:
+                json.dump(report, f, default=str, **kwargs)
+        else:
+            json.dump(report, path_or_buf, default=str, **kwargs)
@@ -3,6 +3,7 @@
 
 # pylint: disable=import-error
 
+import numpy as np
 import pandas as pd
 
 class MappingBase:
@@ -45,12 +46,22 @@ class PftListBase:
         df = clean_column_name(df, 1, 'pft')
         return df.explode('pft')
 
+    @classmethod
+    def _get_list_mapping(cls, df, mapping):
+        # The list can also be created from an already converted mapping, 
+        # e.g. by read_csv() which does the conversion more efficiently
+        if (df is None) == (mapping is None):
+            raise ValueError('Either a PFT list or a mapping must be provided')
+
+        if mapping is None:
+            return cls._convert_list_to_mapping(df, cls.key_name) # pylint: disable=no-member
+        return mapping
+
     @classmethod
     def read_csv(cls, filepath_or_buffer, **kwargs):
         key_name = cls.key_name # pylint: disable=no-member
         raw = pd.read_csv(filepath_or_buffer, dtype=str, header=None, **kwargs)
-        df_list = raw.apply(lambda row: pd.Series([row.iloc[0], row.iloc[1:].dropna().to_list()], index=[key_name, 'pft']), axis='columns')
-        return cls(df_list)
+        return cls(mapping=convert_ragged_list_to_mapping(raw, key_name))
 
     @classmethod
     def read_google_sheet(cls, worksheet):
@@ -60,13 +71,13 @@ class PftListBase:
 
 
 class BiomePftList(BiomePftMapping, PftListBase):
-    def __init__(self, df):
-        super().__init__(self._convert_list_to_mapping(df, self.key_name))
+    def __init__(self, df=None, mapping=None):
+        super().__init__(self._get_list_mapping(df, mapping))
 
 
 class TaxaPftList(TaxaPftMapping, PftListBase):
-    def __init__(self, df):
-        super().__init__(self._convert_list_to_mapping(df, self.key_name))
+    def __init__(self, df=None, mapping=None):
+        super().__init__(self._get_list_mapping(df, mapping))
 
 
 def clean_column_name(df, index, name):
@@ -90,3 +101,23 @@ def convert_matrix_to_mapping(matrix, key_name):
     return mapping[mapping.has_pft == 1].filter(items=[key_name, 'pft'])
 
 
+def convert_ragged_list_to_mapping(raw, key_name):
+    """Convert a data frame with the key in the first column and PFTs in the 
+    remaining ones, padded with NaN, into a list of relations between the keys and PFTs.
+    Just like DataFrame.explode() keys without PFTs get a single row with NaN as PFT.
+    """
+    keys = raw.iloc[:, 0].to_numpy()
+    pfts = raw.iloc[:, 1:].to_numpy()
+    has_pft = pd.notna(pfts)
+
+    # np.nonzero() goes through the rows in order, keeping the order of the PFTs for each key
+    rows, columns = np.nonzero(has_pft)
+    empty_rows = np.flatnonzero(~has_pft.any(axis=1))
+
+    all_rows = np.concatenate([rows, empty_rows])
+    all_pfts = np.concatenate([pfts[rows, columns], np.full(len(empty_rows), np.nan, dtype=object)])
+
+    order = np.argsort(all_rows, kind='stable')
+    all_rows = all_rows[order]
+
+    return pd.DataFrame({ key_name: keys[all_rows], 'pft': all_pfts[order] }, index=raw.index[all_rows])
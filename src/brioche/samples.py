@@ -7,6 +7,8 @@ import numpy as np
 import pandas as pd
 from collections import Counter
 
+from .instrumentation import stage
+
 class PollenSamples:
     sample_type = None
 
@@ -19,34 +21,59 @@ class PollenSamples:
         return PollenSamples._read_csv(cls, filepath_or_buffer, site=site, index_col=index_col, **kwargs)
     
     @staticmethod
-    def _read_csv(constructor, filepath_or_buffer, site, index_col, **kwargs):
-        df = pd.read_csv(filepath_or_buffer, index_col=index_col, header=0, **kwargs)
+    def _read_csv(constructor, filepath_or_buffer, site, index_col, dtype=None, **kwargs):
+        with stage('read_csv', site=site) as info:
+            if _is_compact(dtype):
+                df = compact_samples(pd.read_csv(filepath_or_buffer, index_col=index_col, header=0, **kwargs))
+            else:
+                df = pd.read_csv(filepath_or_buffer, index_col=index_col, header=0, dtype=dtype, **kwargs)
+            info['frame'] = df
+
         return constructor(df, site=site)
 
     @classmethod
-    def read_google_sheet(cls, worksheet, index_col=0):
-        return PollenSamples._read_google_sheet(cls, cls.sample_type, worksheet, index_col)
+    def read_parquet(cls, path, site=None, **kwargs):
+        return PollenSamples._read_parquet(cls, path, site=site, **kwargs)
 
     @staticmethod
-    def _read_google_sheet(constructor, sample_type, worksheet, index_col):
-        rows = worksheet.get_all_values(value_render_option='UNFORMATTED_VALUE')
-        columns = [c.strip() for c in rows[0]]
+    def _read_parquet(constructor, path, site, **kwargs):
+        # Parquet files keep the index and column types, so no parsing is needed
+        with stage('read_parquet', site=site) as info:
+            df = info['frame'] = pd.read_parquet(path, **kwargs)
 
-        duplicates = [col for col, cnt in Counter(columns).items() if cnt > 1]
-        if duplicates:
-            raise ValueError(f'Duplicate columns in {worksheet.title}: {duplicates}')
+        return constructor(df, site=site)
 
-        if isinstance(index_col, int):
-            index_col = [index_col]
+    @classmethod
+    def read_google_sheet(cls, worksheet, index_col=0, dtype=None):
+        return PollenSamples._read_google_sheet(cls, cls.sample_type, worksheet, index_col, dtype)
 
-        def parse_row(row):
-            return [sample_type(v or 0) if colnum not in index_col else v
-                    for colnum, v in enumerate(row)]
+    @staticmethod
+    def _read_google_sheet(constructor, sample_type, worksheet, index_col, dtype=None):
+        rows = worksheet.get_all_values(value_render_option='UNFORMATTED_VALUE')
+        df = _parse_sheet_rows(sample_type, rows, worksheet.title, index_col, dtype)
+        return constructor(df, site=worksheet.title)
 
-        data = [parse_row(row) for row in rows[1:]]
-        index = [columns[i] for i in index_col]
+    @classmethod
+    def read_google_workbook(cls, spreadsheet, index_col=0, dtype=None, worksheets=None):
+        """Read samples from all worksheets in a gspread Spreadsheet (or the listed ones)
+        with a single batched request, returning one object per worksheet.
+        """
+        return PollenSamples._read_google_workbook(cls, cls.sample_type, spreadsheet, index_col, dtype, worksheets)
 
-        return constructor(pd.DataFrame.from_records(data, columns=columns, index=index), site=worksheet.title)
+    @staticmethod
+    def _read_google_workbook(constructor, sample_type, spreadsheet, index_col, dtype, worksheets):
+        if worksheets is None:
+            worksheets = spreadsheet.worksheets()
+
+        titles = [worksheet.title for worksheet in worksheets]
+        response = spreadsheet.values_batch_get(
+            [_quote_sheet_title(title) for title in titles],
+            params={'valueRenderOption': 'UNFORMATTED_VALUE'})
+
+        return [
+            constructor(_parse_sheet_rows(sample_type, value_range.get('values', []), title, index_col, dtype), site=title)
+            for title, value_range in zip(titles, response['valueRanges'])
+        ]
 
     @property
     def samples(self): return self._samples
@@ -60,24 +87,33 @@ class PollenSamples:
     def apply(self, sample_func):
         raise NotImplementedError()
 
-    def get_percentages(self, decimals=None): 
+    def get_percentages(self, decimals=None, dtype=None):
         raise NotImplementedError()
 
-    def get_stabilized(self, default_threshold=0.0, decimals=2):
-        percentages = self.get_percentages()
+    def get_stabilized(self, default_threshold=0.0, decimals=2, dtype=None, thresholds=None):
+        with stage('get_stabilized', site=self.site, frame=self.samples):
+            # Go from samples to stabilized values in a single buffer
+            # instead of creating a new data frame for each step
+            values = self._get_percentage_values(_get_calculation_dtype(dtype, decimals))
+
+            threshold = get_threshold_row(self.samples.columns, default_threshold, thresholds, values.dtype)
+            stabilize_percentages(values, threshold, decimals, out=values)
+            values = values.astype(get_float_dtype(dtype, decimals) or values.dtype, copy=False)
 
-        # TODO: support per-taxa thresholds
-        stabilized = (percentages.samples
-                        .sub(default_threshold)
-                        .clip(lower=0)
-                        .apply(np.sqrt)
-                        .round(decimals))
+            stabilized = pd.DataFrame(values, index=self.samples.index, columns=self.samples.columns)
 
         return StabilizedPollenSamples(stabilized, site=self.site, decimals=decimals)
 
+    def _get_percentage_values(self, dtype):
+        """Return the sample percentages as a new array that the caller may modify."""
+        raise NotImplementedError()
+
     def to_csv(self, path_or_buf, decimals=2, **kwargs):
         self.samples.to_csv(path_or_buf, float_format='%.{}f'.format(decimals), **kwargs)
 
+    def to_parquet(self, path, **kwargs):
+        self.samples.to_parquet(path, **kwargs)
+
 
 class PollenCounts(PollenSamples):
     sample_type = int
@@ -85,15 +121,30 @@ class PollenCounts(PollenSamples):
     def apply(self, sample_func):
         return PollenCounts(sample_func(self._samples), self._site)
 
-    def get_percentages(self, decimals=None): 
-        sums = self.samples.sum(axis=1)
-        percentages = self.samples.apply(lambda column: column * 100 / sums).fillna(0.0)
+    def get_percentages(self, decimals=None, dtype=None):
+        with stage('get_percentages', site=self.site, frame=self.samples):
+            percentages = pd.DataFrame(self._get_percentage_values(_get_calculation_dtype(dtype, decimals)),
+                                       index=self.samples.index, columns=self.samples.columns)
 
-        if decimals is not None:
-            percentages = percentages.round(decimals)
+            if decimals is not None:
+                percentages = percentages.round(decimals)
+            if _is_compact(dtype):
+                percentages = percentages.astype(get_float_dtype(dtype, decimals))
 
         return PollenPercentages(percentages, self.site)
 
+    def _get_percentage_values(self, dtype):
+        # Normalize the rows of a copy of the counts in place, using float32
+        # instead of the default float64 halves the memory needed
+        values = self.samples.to_numpy(dtype=dtype or np.float64, copy=True)
+        sums = np.nansum(values, axis=1, keepdims=True)
+
+        values *= 100
+        np.divide(values, sums, out=values, where=sums != 0)
+        values[np.isnan(values)] = 0.0
+
+        return values
+
 
 class PollenPercentages(PollenSamples):
     sample_type = float
@@ -101,11 +152,22 @@ class PollenPercentages(PollenSamples):
     def apply(self, sample_func):
         return PollenPercentages(sample_func(self._samples), self._site)
 
-    def get_percentages(self, decimals=None):
-        if decimals is None:
+    def get_percentages(self, decimals=None, dtype=None):
+        if decimals is None and dtype is None:
             return self
-        else:
-            return PollenPercentages(self.samples.round(decimals), self.site)
+
+        percentages = self.samples
+        if dtype is not None:
+            percentages = percentages.astype(_get_calculation_dtype(dtype, decimals))
+        if decimals is not None:
+            percentages = percentages.round(decimals)
+        if _is_compact(dtype):
+            percentages = percentages.astype(get_float_dtype(dtype, decimals))
+
+        return PollenPercentages(percentages, self.site)
+
+    def _get_percentage_values(self, dtype):
+        return self.samples.to_numpy(dtype=dtype or np.float64, copy=True)
 
 
 class StabilizedPollenSamples(PollenSamples):
@@ -121,7 +183,7 @@ class StabilizedPollenSamples(PollenSamples):
     def apply(self, sample_func):
         return StabilizedPollenSamples(sample_func(self._samples).round(self._decimals), self._decimals, self._site)
 
-    def get_stabilized(self, default_threshold=0.0, decimals=2):
+    def get_stabilized(self, default_threshold=0.0, decimals=2, dtype=None, thresholds=None):
         # TODO: round if decimals are fewer than this is set up to use
         return self
 
@@ -130,8 +192,16 @@ class StabilizedPollenSamples(PollenSamples):
         return PollenSamples._read_csv(lambda samples, site=None: cls(samples, decimals, site=site), filepath_or_buffer, site=site, index_col=index_col, **kwargs)
 
     @classmethod
-    def read_google_sheet(cls, worksheet, decimals, index_col=0):
-        return PollenSamples._read_google_sheet(lambda samples, site=None: cls(samples, decimals, site=site), cls.sample_type, worksheet, index_col)
+    def read_parquet(cls, path, decimals, site=None, **kwargs):
+        return PollenSamples._read_parquet(lambda samples, site=None: cls(samples, decimals, site=site), path, site=site, **kwargs)
+
+    @classmethod
+    def read_google_sheet(cls, worksheet, decimals, index_col=0, dtype=None):
+        return PollenSamples._read_google_sheet(lambda samples, site=None: cls(samples, decimals, site=site), cls.sample_type, worksheet, index_col, dtype)
+
+    @classmethod
+    def read_google_workbook(cls, spreadsheet, decimals, index_col=0, dtype=None, worksheets=None):
+        return PollenSamples._read_google_workbook(lambda samples, site=None: cls(samples, decimals, site=site), cls.sample_type, spreadsheet, index_col, dtype, worksheets)
 
     def to_csv(self, path_or_buf, decimals=None, **kwargs):
         if decimals is None:
@@ -142,3 +212,138 @@ class StabilizedPollenSamples(PollenSamples):
     @staticmethod
     def _parse_sample_string(s):
         return float(s) if s else 0.0
+
+
+def _quote_sheet_title(title):
+    return "'{}'".format(title.replace("'", "''"))
+
+
+def _parse_sheet_rows(sample_type, rows, title, index_col, dtype):
+    columns = [str(c).strip() for c in rows[0]] if rows else []
+
+    duplicates = [col for col, cnt in Counter(columns).items() if cnt > 1]
+    if duplicates:
+        raise ValueError(f'Duplicate columns in {title}: {duplicates}')
+
+    if isinstance(index_col, int):
+        index_col = [index_col]
+
+    # The Sheets API leaves out empty cells at the end of rows, so pad them
+    # to get a rectangular array that can be converted one column at a time
+    values = np.full((max(len(rows) - 1, 0), len(columns)), '', dtype=object)
+    for i, row in enumerate(rows[1:]):
+        values[i, :len(row)] = row[:len(columns)]
+
+    data = {}
+    for colnum, column in enumerate(columns):
+        column_values = values[:, colnum]
+
+        if colnum in index_col:
+            data[column] = column_values.tolist()
+        else:
+            # Empty cells are zero
+            column_values[(column_values == '') | pd.isna(column_values)] = 0
+            data[column] = column_values.astype(sample_type)
+
+    df = pd.DataFrame(data, columns=columns).set_index([columns[i] for i in index_col])
+
+    if _is_compact(dtype):
+        df = compact_samples(df)
+    elif dtype is not None:
+        df = df.astype(dtype)
+
+    return df
+
+
+# Float32 holds about 7 significant digits, which is enough to store percentages up to 100
+# and stabilized values rounded to this many decimals.  The values are still calculated
+# and rounded as float64, since float32 rounding errors can move values that are close
+# to halfway between two decimals to the other side.
+COMPACT_MAX_DECIMALS = 3
+
+def _is_compact(dtype):
+    return isinstance(dtype, str) and dtype == 'compact'
+
+
+def get_float_dtype(dtype, decimals):
+    """Resolve the dtype policy for calculated sample values.  'compact' 
+    means float32 where the precision is enough for the decimals, otherwise float64.
+    """
+    if _is_compact(dtype):
+        if decimals is not None and decimals <= COMPACT_MAX_DECIMALS:
+            return np.float32
+        return np.float64
+
+    return dtype
+
+
+def _get_calculation_dtype(dtype, decimals):
+    if _is_compact(dtype):
+        return np.float64
+    return get_float_dtype(dtype, decimals)
+
+
+def compact_samples(samples):
+    """Downcast sample values to the smallest type that can hold them:
+    the smallest integer type for counts and float32 for anything else.
+    """
+    if len(samples.columns) and all(pd.api.types.is_integer_dtype(t) for t in samples.dtypes):
+        low = samples.min().min()
+        high = samples.max().max()
+
+        if low >= 0:
+            candidates = (np.uint8, np.uint16, np.uint32)
+        else:
+            candidates = (np.int8, np.int16, np.int32)
+
+        for candidate in candidates:
+            info = np.iinfo(candidate)
+            if info.min <= low and high <= info.max:
+                return samples.astype(candidate)
+
+        return samples
+
+    return samples.astype(np.float32)
+
+
+def read_thresholds_csv(filepath_or_buffer, **kwargs):
+    """Read per-taxa stabilization thresholds from a CSV file without header,
+    with the taxa in the first column and the threshold in the second.
+    """
+    df = pd.read_csv(filepath_or_buffer, header=None, index_col=0, dtype={0: str, 1: float}, **kwargs)
+
+    duplicates = [taxa for taxa, cnt in Counter(df.index).items() if cnt > 1]
+    if duplicates:
+        raise ValueError(f'Duplicate taxas in thresholds: {duplicates}')
+
+    thresholds = df.iloc[:, 0]
+    thresholds.index.name = 'taxa'
+    thresholds.name = 'threshold'
+    return thresholds
+
+
+def get_threshold_row(taxas, default_threshold=0.0, thresholds=None, dtype=np.float64):
+    """Turn per-taxa thresholds into a row to subtract from all samples with
+    the given taxa columns, using the default threshold for taxas that aren't
+    listed.  Without per-taxa thresholds this is just the default threshold.
+    """
+    if thresholds is None:
+        return default_threshold
+
+    return (pd.Series(thresholds, dtype=float)
+            .reindex(taxas)
+            .fillna(default_threshold)
+            .to_numpy(dtype=dtype))
+
+
+def stabilize_percentages(percentages, threshold=0.0, decimals=2, out=None):
+    """Stabilize an array of sample percentages by taking the square root of
+    the part that is above the threshold, rounded to the given decimals.
+    The threshold can be a single value or one value per column.
+    All steps are done in place in out, which may be the percentages array
+    itself.  If out is None a new array is allocated.
+    """
+    out = np.subtract(percentages, threshold, out=out)
+    np.maximum(out, 0, out=out)
+    np.sqrt(out, out=out)
+    return np.round(out, decimals, out=out)
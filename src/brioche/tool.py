@@ -1,84 +1,452 @@
 # Copyright 2020 Peter Liljenberg <peter.liljenberg@gmail.com>
 # Open source under the MIT license (see LICENSE)
 
-"""Command line tool to run brioche on CSV files.
+"""Command line tool to run brioche on CSV or Parquet files.
 """
 
+import io
 import os
 import argparse
+import hashlib
+import tempfile
+import zipfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
 
 from . import __version__
 from .mappings import BiomePftList, TaxaPftList
-from .samples import PollenCounts, PollenPercentages, StabilizedPollenSamples
-from .biomization import Biomization
+from .samples import PollenCounts, PollenPercentages, StabilizedPollenSamples, read_thresholds_csv
+from .biomization import Biomization, SAVE_FORMAT_VERSION
+from .chunked import biomize_csv_in_chunks
+from .instrumentation import Profile, get_recorder, recording, stage
+
+SAMPLE_CLASSES = dict(counts=PollenCounts, percentages=PollenPercentages, stabilized=StabilizedPollenSamples)
 
 parser = argparse.ArgumentParser(description='Perform biome affinity analysis of pollen samples')
 parser.add_argument('--version', action='version', version='%(prog)s {}'.format(__version__))
 parser.add_argument('--separator', '-s', default=',', help='Column separator (default comma)', metavar='CHAR/REGEXP')
 parser.add_argument('--decimals', type=int, choices=range(5), default=2, help='Decimals to use in stabilized sample values (default 2)')
 parser.add_argument('--default-threshold', '-d', type=float, default=0.5, help='Default sample stabilization threshold (default 0.5)', metavar='THRESHOLD')
+parser.add_argument('--thresholds', dest='thresholds_file', help='Per-taxa stabilization threshold CSV file without header, with taxa and threshold columns. Unlisted taxas use the default threshold', metavar='THRESHOLDS.CSV')
 parser.add_argument('--type', choices=['counts', 'percentages', 'stabilized'], 
     default='counts', help='Type of values in the pollen sample files (default counts)')
+parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+    help='Format of the output files (default csv). Sample files ending in .parquet are always read as Parquet')
 parser.add_argument('--save-percentages', action='store_true', help='Save calculated sample percentages')
 parser.add_argument('--save-stabilized', action='store_true', help='Save calculated stabilized sample values')
+parser.add_argument('--top-biomes', type=int, help='Save the K biomes with the highest scores and the margin between the two best', metavar='K')
 parser.add_argument('--taxas', '-t', required=True, help='Taxa to PFT mapping CSV file', metavar='TAXAS.CSV')
 parser.add_argument('--biomes', '-b', required=True, help='Biome to PFT mapping CSV file', metavar='BIOMES.CSV')
+parser.add_argument('--cache-dir', help='Directory to cache the biomization built from the taxa and biome mapping files in, reused while the files are unchanged', metavar='DIR')
+parser.add_argument('--chunk-rows', type=int, help='Read and process CSV sample files in blocks of N rows, to handle files that do not fit in memory', metavar='N')
+parser.add_argument('--stream', action='store_true', help='Read and process one site at a time, reporting unmapped taxas at the end')
+parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of sites to process in parallel (default 1)', metavar='N')
+parser.add_argument('--incremental', action='store_true', help='Only process samples with index values that are not in the existing output files yet, adding them to the files sorted by index (CSV only)')
+parser.add_argument('--profile', help='Write the time and memory used by each processing stage to a JSON file', metavar='PROFILE.JSON')
 parser.add_argument('--index', type=int, action='append', help='Index column, counting from 0 (repeat option if there are multiple index columns). If omitted the first column is used')
 parser.add_argument('samples', nargs='+', help='Pollen sample CSV files', metavar='SAMPLE.CSV')
 
 def main(cli_args=None):
     args = parser.parse_args(cli_args)
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.top_biomes is not None and args.top_biomes < 1:
+        parser.error('--top-biomes must be at least 1')
+    if args.chunk_rows is not None:
+        if args.chunk_rows < 1:
+            parser.error('--chunk-rows must be at least 1')
+        if args.format != 'csv' or any(sample.endswith('.parquet') for sample in args.samples):
+            parser.error('--chunk-rows only supports CSV files')
+    if args.incremental:
+        if args.format != 'csv':
+            parser.error('--incremental only supports CSV files')
+        if args.chunk_rows is not None:
+            parser.error('--incremental cannot be combined with --chunk-rows')
+
+    args.thresholds = None
+    if args.thresholds_file:
+        args.thresholds = read_thresholds_csv(args.thresholds_file, sep=args.separator)
+
+    if not args.profile:
+        run(args)
+        return
+
+    profile = Profile()
+    tracemalloc.start()
+    try:
+        with recording(profile):
+            run(args)
+    finally:
+        tracemalloc.stop()
+
+    profile.to_json(args.profile, indent=2)
+
+
+def run(args):
+    biomization = get_biomization(args)
+
+    if args.jobs > 1:
+        process_sites_in_parallel(biomization, args)
+        return
+
+    if args.stream or args.chunk_rows:
+        process_sites_streaming(biomization, args)
+        return
+
+    samples = list(read_samples(args))
+
+    print_unmapped_taxas(biomization.get_unmapped_taxas(*samples))
+
+    for sample in samples:
+        process_site(biomization, sample, args)
+
+
+def get_biomization(args):
+    if not args.cache_dir:
+        return build_biomization(args)
+
+    # The cache file name is a hash of the mapping files contents and
+    # how they are parsed, so any change to them results in a new file
+    key = hashlib.sha256()
+    key.update('{}\0{}\0'.format(SAVE_FORMAT_VERSION, args.separator).encode('utf-8'))
+    for path in (args.taxas, args.biomes):
+        with open(path, 'rb') as f:
+            key.update(hashlib.sha256(f.read()).digest())
+
+    cache_path = os.path.join(args.cache_dir, 'biomization-{}.npz'.format(key.hexdigest()))
+
+    if os.path.exists(cache_path):
+        try:
+            with stage('load_biomization'):
+                return Biomization.load(cache_path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # A cache file that can't be read is rebuilt just like a missing one
+            pass
+
+    biomization = build_biomization(args)
+
+    # Write to a temporary file first so concurrent runs never see a partial cache file
+    os.makedirs(args.cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=args.cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            biomization.save(f)
+
+        # mkstemp() only lets the current user read the file, but the cache
+        # directory may be shared so use the same mode as any new file
+        os.chmod(tmp_path, 0o666 & ~_get_umask())
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return biomization
+
+
+def _get_umask():
+    # The umask can only be read by setting it
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def build_biomization(args):
     taxas = TaxaPftList.read_csv(args.taxas, sep=args.separator)
     biomes = BiomePftList.read_csv(args.biomes, sep=args.separator)
-    samples = list(read_samples(args))
+    return Biomization(taxas, biomes)
+
+
+def process_site_file(biomization, path, args, log=print):
+    """Read and process a single sample file, returning the unmapped taxas in it."""
+    if args.chunk_rows:
+        return process_site_file_in_chunks(biomization, path, args, log)
+
+    sample = read_sample(path, args)
+    process_site(biomization, sample, args, log)
+    return biomization.get_unmapped_taxas(sample)
+
+
+def process_site_file_in_chunks(biomization, path, args, log=print):
+    log('Reading samples from:', path)
+
+    base = os.path.splitext(path)[0]
+
+    biomes_path = '{}_biomes.csv'.format(base)
+    scores_path = '{}_scores.csv'.format(base)
+    percentages_path = '{}_percentages.csv'.format(base) if args.save_percentages else None
+    stabilized_path = '{}_stabilized.csv'.format(base) if args.save_stabilized else None
+    top_biomes_path = '{}_top_biomes.csv'.format(base) if args.top_biomes else None
+
+    unmapped = biomize_csv_in_chunks(
+        biomization, SAMPLE_CLASSES[args.type], path, args.chunk_rows,
+        biomes_path, scores_path,
+        percentages_path=percentages_path, stabilized_path=stabilized_path,
+        top_biomes_path=top_biomes_path, top_biomes=args.top_biomes,
+        default_threshold=args.default_threshold, thresholds=args.thresholds, decimals=args.decimals,
+        site=path, index_col=args.index or [0], sep=args.separator)
+
+    if percentages_path:
+        log('Wrote percentages to:', percentages_path)
+    if stabilized_path:
+        log('Wrote stabilized to: ', stabilized_path)
+    log('Wrote biomes to:     ', biomes_path)
+    log('Wrote scores to:     ', scores_path)
+    if top_biomes_path:
+        log('Wrote top biomes to: ', top_biomes_path)
+    log()
+
+    return unmapped
+
+
+def process_site(biomization, sample, args, log=print):
+    with stage('process_site', site=sample.site, frame=sample.samples):
+        if args.incremental and process_site_incrementally(biomization, sample, args, log):
+            return
+        _process_site(biomization, sample, args, log)
+
+
+def _process_site(biomization, sample, args, log):
+    log('Reading samples from:', sample.site)
+
+    base = os.path.splitext(sample.site)[0]
+
+    biomes_path = '{}_biomes.{}'.format(base, args.format)
+    scores_path = '{}_scores.{}'.format(base, args.format)
 
-    biomization = Biomization(taxas, biomes)
+    stabilized = sample.get_stabilized(default_threshold=args.default_threshold, decimals=args.decimals,
+                                       thresholds=args.thresholds)
 
-    unmapped = biomization.get_unmapped_taxas(*samples)
+    if args.save_percentages:
+        percentages_path = '{}_percentages.{}'.format(base, args.format)
+        percentages = sample.get_percentages(args.decimals)
+        if args.format == 'parquet':
+            percentages.to_parquet(percentages_path)
+        else:
+            percentages.to_csv(percentages_path, decimals=args.decimals, sep=args.separator)
+        log('Wrote percentages to:', percentages_path)
+
+    if args.save_stabilized:
+        stabilized_path = '{}_stabilized.{}'.format(base, args.format)
+        if args.format == 'parquet':
+            stabilized.to_parquet(stabilized_path)
+        else:
+            stabilized.to_csv(stabilized_path, sep=args.separator)
+        log('Wrote stabilized to: ', stabilized_path)
+
+    affinity = biomization.get_biome_affinity(stabilized)
+    with stage('write_biomes', site=sample.site, frame=stabilized.samples):
+        if args.format == 'parquet':
+            affinity.biomes_to_parquet(biomes_path)
+            affinity.scores_to_parquet(scores_path)
+        else:
+            affinity.biomes_to_csv(biomes_path, sep=args.separator)
+            affinity.scores_to_csv(scores_path, sep=args.separator)
+
+    log('Wrote biomes to:     ', biomes_path)
+    log('Wrote scores to:     ', scores_path)
+
+    if args.top_biomes:
+        top_biomes_path = '{}_top_biomes.{}'.format(base, args.format)
+        if args.format == 'parquet':
+            affinity.top_biomes_to_parquet(top_biomes_path, k=args.top_biomes)
+        else:
+            affinity.top_biomes_to_csv(top_biomes_path, k=args.top_biomes, sep=args.separator)
+        log('Wrote top biomes to: ', top_biomes_path)
+    log()
+
+
+def process_site_incrementally(biomization, sample, args, log=print):
+    """Process only the samples that are not in the existing output files,
+    merging them into the files.  Returns False if the site must be processed
+    from scratch, since some output file is missing or has different columns
+    or index type.
+    """
+    base = os.path.splitext(sample.site)[0]
+    index_count = len(args.index or [0])
+
+    names = ['biomes', 'scores']
+    if args.save_percentages:
+        names.append('percentages')
+    if args.save_stabilized:
+        names.append('stabilized')
+    if args.top_biomes:
+        names.append('top_biomes')
+
+    paths = {name: '{}_{}.csv'.format(base, name) for name in names}
+    if not all(os.path.exists(path) for path in paths.values()):
+        return False
+
+    # Keep the existing values as strings to write them back exactly as they were
+    existing = {}
+    for name, path in paths.items():
+        with open(path, 'rt') as f:
+            existing[name] = read_output_csv(f.read(), index_count, args.separator)
+
+    # A full run would format all index values differently if their type changes,
+    # e.g. when the first depth with decimals is added
+    if _get_index_dtypes(existing['biomes'][1]) != _get_index_dtypes(sample.samples.index):
+        return False
+
+    # Percentages, stabilization and affinity are calculated row by row,
+    # so the new samples can be processed on their own
+    new_rows = ~sample.samples.index.isin(existing['biomes'][1])
+    if not new_rows.any():
+        log('Reading samples from:', sample.site)
+        log('No new samples in:   ', sample.site)
+        log()
+        return True
+
+    new_sample = sample.apply(lambda samples: samples[new_rows])
+    stabilized = new_sample.get_stabilized(default_threshold=args.default_threshold, decimals=args.decimals,
+                                           thresholds=args.thresholds)
+    affinity = biomization.get_biome_affinity(stabilized)
+
+    writers = dict(
+        biomes=lambda buf: affinity.biomes_to_csv(buf, sep=args.separator),
+        scores=lambda buf: affinity.scores_to_csv(buf, sep=args.separator),
+        percentages=lambda buf: new_sample.get_percentages(args.decimals).to_csv(
+            buf, decimals=args.decimals, sep=args.separator),
+        stabilized=lambda buf: stabilized.to_csv(buf, sep=args.separator),
+        top_biomes=lambda buf: affinity.top_biomes_to_csv(buf, k=args.top_biomes, sep=args.separator),
+    )
+
+    merged = {}
+    for name in names:
+        # Format the new rows just like a full run would
+        buf = io.StringIO()
+        writers[name](buf)
+        new_values, new_index = read_output_csv(buf.getvalue(), index_count, args.separator)
+        old_values, old_index = existing[name]
+
+        if list(new_values.columns) != list(old_values.columns):
+            return False
+
+        # Sort by the parsed index, but write the index as it was formatted in the files
+        order = pd.Series(range(len(old_index) + len(new_index)),
+                          index=old_index.append(new_index)).sort_index(kind='stable')
+        merged[name] = pd.concat([old_values, new_values]).iloc[order.to_numpy()]
+
+    with stage('write_biomes', site=sample.site, frame=stabilized.samples):
+        for name in names:
+            merged[name].to_csv(paths[name], sep=args.separator)
+
+    log('Reading samples from:', sample.site)
+    for name in names:
+        log('Added {} samples to:'.format(new_rows.sum()), paths[name])
+    log()
+    return True
+
+
+def read_output_csv(text, index_count, sep):
+    """Read an output CSV file with all values, including the index, as the
+    strings in the file.  Returns the values and the index parsed like the
+    sample files are, to compare and sort by.
+    """
+    index = pd.read_csv(io.StringIO(text), sep=sep, usecols=range(index_count))
+    values = pd.read_csv(io.StringIO(text), sep=sep, dtype=str, keep_default_na=False)
+    values = values.set_index(list(values.columns[:index_count]))
+
+    index = pd.MultiIndex.from_frame(index) if index_count > 1 else pd.Index(index.iloc[:, 0])
+    return values, index
+
+
+def _get_index_dtypes(index):
+    if isinstance(index, pd.MultiIndex):
+        return list(index.dtypes)
+    return [index.dtype]
+
+
+def print_unmapped_taxas(unmapped):
     if unmapped:
         print('Warning: sample files contain taxas that are not mapped to any biome:')
-        for t in unmapped:
+        for t in sorted(unmapped):
             print(t)
         print()
 
-    for sample in samples:
-        print('Reading samples from:', sample.site)
 
-        base = os.path.splitext(sample.site)[0]
+def process_sites_streaming(biomization, args):
+    # Only keep one site in memory at a time, collecting the unmapped taxas
+    # as the sites are processed to report them once all are done.
+    unmapped = set()
 
-        biomes_path = '{}_biomes.csv'.format(base)
-        scores_path = '{}_scores.csv'.format(base)
+    for path in args.samples:
+        unmapped.update(process_site_file(biomization, path, args))
 
-        stabilized = sample.get_stabilized(default_threshold=args.default_threshold, decimals=args.decimals)
+    print_unmapped_taxas(unmapped)
 
-        if args.save_percentages:
-            percentages_path = '{}_percentages.csv'.format(base)
-            sample.get_percentages(args.decimals).to_csv(percentages_path, decimals=args.decimals, sep=args.separator)
-            print('Wrote percentages to:', percentages_path)
 
-        if args.save_stabilized:
-            stabilized_path = '{}_stabilized.csv'.format(base)
-            stabilized.to_csv(stabilized_path, sep=args.separator)
-            print('Wrote stabilized to: ', stabilized_path)
+def process_sites_in_parallel(biomization, args):
+    # The biomization is passed to each worker process once when it starts,
+    # and the workers then read, process and write one site file per task.
+    # The output is collected and printed in the order of the sample files
+    # so it is the same as when processing the sites sequentially.
+    chunksize = max(1, len(args.samples) // (args.jobs * 4))
 
-        affinity = biomization.get_biome_affinity(stabilized)
-        affinity.biomes_to_csv(biomes_path, sep=args.separator)
-        affinity.scores_to_csv(scores_path, sep=args.separator)
+    with ProcessPoolExecutor(max_workers=args.jobs,
+                             initializer=_init_worker, initargs=(biomization, args)) as executor:
+        results = list(executor.map(_process_site_file, args.samples, chunksize=chunksize))
 
-        print('Wrote biomes to:     ', biomes_path)
-        print('Wrote scores to:     ', scores_path)
-        print()
+    # Stages recorded by the workers are passed on to the recorder in this process
+    recorder = get_recorder()
+    if recorder is not None:
+        for _, _, stages in results:
+            for record in stages:
+                recorder(record)
 
+    unmapped = set()
+    for site_unmapped, _, _ in results:
+        unmapped.update(site_unmapped)
 
-def read_samples(args):
-    index_col = args.index or [0]
+    print_unmapped_taxas(unmapped)
+
+    for _, messages, _ in results:
+        for message in messages:
+            print(*message)
+
+
+_worker_biomization = None
+_worker_args = None
 
+def _init_worker(biomization, args):
+    global _worker_biomization, _worker_args # pylint: disable=global-statement
+    _worker_biomization = biomization
+    _worker_args = args
+    if args.profile:
+        tracemalloc.start()
+
+def _process_site_file(path):
+    messages = []
+    profile = Profile()
+    with recording(profile if _worker_args.profile else None):
+        unmapped = process_site_file(_worker_biomization, path, _worker_args, log=lambda *message: messages.append(message))
+    return unmapped, messages, profile.stages
+
+
+def read_samples(args):
     for sample in args.samples:
+        yield read_sample(sample, args)
+
+
+def read_sample(sample, args):
+    if sample.endswith('.parquet'):
         if args.type == 'counts':
-            yield PollenCounts.read_csv(sample, site=sample, index_col=index_col, sep=args.separator)
+            return PollenCounts.read_parquet(sample, site=sample)
 
         elif args.type == 'percentages':
-            yield PollenPercentages.read_csv(sample, site=sample, index_col=index_col, sep=args.separator)
+            return PollenPercentages.read_parquet(sample, site=sample)
 
         elif args.type == 'stabilized':
-            yield StabilizedPollenSamples.read_csv(sample, decimals=args.decimals, site=sample, index_col=index_col, sep=args.separator)
+            return StabilizedPollenSamples.read_parquet(sample, decimals=args.decimals, site=sample)
+
+    index_col = args.index or [0]
+
+    if args.type == 'counts':
+        return PollenCounts.read_csv(sample, site=sample, index_col=index_col, sep=args.separator)
+
+    elif args.type == 'percentages':
+        return PollenPercentages.read_csv(sample, site=sample, index_col=index_col, sep=args.separator)
+
+    elif args.type == 'stabilized':
+        return StabilizedPollenSamples.read_csv(sample, decimals=args.decimals, site=sample, index_col=index_col, sep=args.separator)
@@ -3,15 +3,20 @@
 
 # pylint: disable=missing-function-docstring missing-module-docstring import-error
 
+import io
+import numpy as np
 import pandas as pd
 import pytest
 
+import brioche.biomization
+
 from brioche import \
     BiomePftMatrix, TaxaPftMatrix, \
     BiomePftList, TaxaPftList, \
+    BiomePftMapping, TaxaPftMapping, \
     Biomization, PollenCounts, \
     StabilizedPollenSamples, \
-    BiomeAffinity
+    BiomeAffinity, SparseTaxaBiomeMatrix
 
 def test_join_matrix_mappings_into_biome_matrix():
     # taxa1: maps only through PFT 1 to biome 2
@@ -318,3 +323,630 @@ def test_apply_function_to_affinity_scores():
     assert new_affinity.site == affinity.site
     assert new_affinity._decimals == affinity._decimals
     assert new_affinity._specificity_scores is affinity._specificity_scores
+
+
+@pytest.mark.parametrize('data', [
+    dict(
+        row1=[1.5, 7.0, 2.25, 0.0],
+        row2=[0.0, 3.0, None, 4.5],
+        row3=[0.0, 0.0, 0.0, 0.0],
+    ),
+    dict(
+        row1=[5, 1, 3, 0],
+        row2=[0, 0, 0, 0],
+    ),
+])
+def test_matmul_and_loop_engines_give_the_same_scores(data):
+    taxa_pfts = TaxaPftMatrix(pd.DataFrame.from_records(
+            columns=('taxa', 1, 2, 3),
+            data=[
+                ('taxa1', 1, 1, 0),
+                ('taxa2', 0, 1, 1),
+                ('taxa3', 0, 0, 1),
+                ]))
+
+    biome_pfts = BiomePftMatrix(pd.DataFrame.from_records(
+            columns=('biome', 1, 2, 3),
+            data=[
+                ('biome1', 1, 0, 0),
+                ('biome2', 0, 1, 0),
+                ('biome3', 1, 0, 1)
+                ]))
+
+    samples = StabilizedPollenSamples(
+        samples=pd.DataFrame.from_dict(
+            orient='index',
+            columns=('taxa3', 'unmapped', 'taxa1', 'taxa2'),
+            data=data),
+        decimals=2,
+        site="test")
+
+    biomization = Biomization(taxa_pfts, biome_pfts)
+    matmul = biomization.get_biome_affinity(samples, engine='matmul')
+    loop = biomization.get_biome_affinity(samples, engine='loop')
+
+    assert list(matmul.scores.dtypes) == [np.float64] * 3
+    pd.testing.assert_frame_equal(matmul.scores, loop.scores)
+    pd.testing.assert_series_equal(matmul.biomes, loop.biomes)
+
+
+def test_unknown_engine_raises_error():
+    taxa_pfts = TaxaPftMatrix(pd.DataFrame.from_records(
+            columns=('taxa', 1),
+            data=[('taxa1', 1)]))
+
+    biome_pfts = BiomePftMatrix(pd.DataFrame.from_records(
+            columns=('biome', 1),
+            data=[('biome1', 1)]))
+
+    samples = StabilizedPollenSamples(
+        samples=pd.DataFrame.from_dict(
+            orient='index',
+            columns=('taxa1', ),
+            data=dict(row=[1.0])),
+        decimals=1)
+
+    biomization = Biomization(taxa_pfts, biome_pfts)
+
+    with pytest.raises(ValueError):
+        biomization.get_biome_affinity(samples, engine='foo')
+
+
+def test_sparse_taxa_biome_matrix():
+    taxa_pfts = TaxaPftMatrix(pd.DataFrame.from_records(
+            columns=('taxa', 1, 2, 3, 4),
+            data=[
+                ('taxa1', 1, 0, 1, 0),
+                ('taxa2', 0, 1, 1, 0),
+                ('taxa3', 0, 0, 1, 0),
+                ('taxa4', 1, 1, 1, 1)
+                ]))
+
+    biome_pfts = BiomePftMatrix(pd.DataFrame.from_records(
+            columns=('biome', 1, 2, 4),
+            data=[
+                ('biome1', 0, 1, 1),
+                ('biome2', 1, 0, 1)
+                ]))
+
+    biomization = Biomization(taxa_pfts, biome_pfts)
+    sparse = biomization.taxa_biome_sparse_matrix
+
+    assert type(sparse) == SparseTaxaBiomeMatrix
+    assert list(sparse.taxas) == ['taxa1', 'taxa2', 'taxa4']
+    assert list(sparse.biomes) == ['biome1', 'biome2']
+    assert sparse.shape == (3, 2)
+    assert list(sparse.indptr) == [0, 1, 2, 4]
+    assert list(sparse.indices) == [1, 0, 0, 1]
+
+    assert sparse.get_dense_rows([2, 0]).tolist() == [[1, 1], [0, 1]]
+    assert sparse.get_taxas_per_biome().to_dict() == dict(biome1=2, biome2=2)
+
+
+def test_taxa_biome_matrix_matches_pivot_table():
+    # taxa2 and biome2 have no PFTs, which the join relates to each other
+    taxa_pfts = TaxaPftList(pd.DataFrame.from_records(
+            columns=('taxa', 'pft'),
+            data=[
+                ('taxa3', ['2', '1']),
+                ('taxa1', ['1']),
+                ('taxa2', []),
+                ('taxa4', ['3', '2']),
+                ('taxa5', ['4']),
+                ]))
+
+    biome_pfts = BiomePftList(pd.DataFrame.from_records(
+            columns=('biome', 'pft'),
+            data=[
+                ('biome3', ['1', '2']),
+                ('biome1', ['2', '3']),
+                ('biome2', []),
+                ('biome4', ['5']),
+                ]))
+
+    biomization = Biomization(taxa_pfts, biome_pfts)
+
+    expected = biomization.taxa_biome_mapping.pivot_table(
+        index='taxa', columns='biome', values='pft',
+        aggfunc=lambda v: 1,
+        fill_value=0)
+
+    pd.testing.assert_frame_equal(biomization.taxa_biome_matrix, expected)
+    pd.testing.assert_series_equal(biomization._taxas_per_biome, expected.sum(axis='index'))
+
+
+def batch_biomization():
+    taxa_pfts = TaxaPftMatrix(pd.DataFrame.from_records(
+            columns=('taxa', 1, 2, 3),
+            data=[
+                ('taxa1', 1, 1, 0),
+                ('taxa2', 0, 1, 1),
+                ('taxa3', 0, 0, 1),
+                ]))
+
+    biome_pfts = BiomePftMatrix(pd.DataFrame.from_records(
+            columns=('biome', 1, 2, 3),
+            data=[
+                ('biome1', 1, 0, 0),
+                ('biome2', 0, 1, 0),
+                ('biome3', 0, 0, 1)
+                ]))
+
+    return Biomization(taxa_pfts, biome_pfts)
+
+def batch_sites():
+    return [
+        StabilizedPollenSamples(
+            samples=pd.DataFrame.from_dict(
+                orient='index',
+                columns=('taxa1', 'taxa2'),
+                data={10: [5.0, 0.0], 20: [1.0, 2.0]}),
+            decimals=1,
+            site='site1'),
+        StabilizedPollenSamples(
+            samples=pd.DataFrame.from_dict(
+                orient='index',
+                columns=('taxa3', 'taxa4', 'taxa2'),
+                data={10: [3.0, 8.0, 1.0]}),
+            decimals=1,
+            site='site2'),
+    ]
+
+def test_get_biome_affinities_for_multiple_sites():
+    biomization = batch_biomization()
+    sites = batch_sites()
+
+    affinities = biomization.get_biome_affinities(*sites)
+
+    assert [a.site for a in affinities] == ['site1', 'site2']
+    for site, affinity in zip(sites, affinities):
+        expected = biomization.get_biome_affinity(site)
+        pd.testing.assert_frame_equal(affinity.scores, expected.scores)
+        pd.testing.assert_series_equal(affinity.biomes, expected.biomes)
+        pd.testing.assert_series_equal(affinity._specificity_scores, expected._specificity_scores)
+
+def test_get_combined_biome_affinities_for_multiple_sites():
+    biomization = batch_biomization()
+
+    affinity = biomization.get_biome_affinities(*batch_sites(), combined=True)
+
+    assert affinity.biomes.to_dict() == {
+        ('site1', 10): 'biome1',
+        ('site1', 20): 'biome2',
+        ('site2', 10): 'biome3',
+    }
+    assert affinity.scores.loc[('site2', 10)].to_dict() == dict(
+        biome1=pytest.approx(0), biome2=pytest.approx(1), biome3=pytest.approx(4))
+
+def test_combined_biome_affinities_require_same_decimals():
+    biomization = batch_biomization()
+    site1, site2 = batch_sites()
+    site2 = StabilizedPollenSamples(site2.samples, decimals=2, site=site2.site)
+
+    with pytest.raises(ValueError):
+        biomization.get_biome_affinities(site1, site2, combined=True)
+
+
+def test_biomes_are_categorical():
+    affinity = BiomeAffinity(
+        affinity_scores=pd.DataFrame.from_records(
+            columns=('BiomeA', 'BiomeB'),
+            data=[
+                (5.0, 5.0),
+                (0.0, 0.0),
+                (1.0, 4.0),
+            ]),
+        specificity_scores=pd.Series(
+            [0.02, 0.01],
+            ['BiomeA', 'BiomeB']),
+        decimals=1,
+        site='test')
+
+    assert affinity.biomes.dtype == 'category'
+    assert list(affinity.biomes.cat.categories) == ['BiomeA', 'BiomeB', 'N/A']
+    assert list(affinity.biomes) == ['BiomeB', 'N/A', 'BiomeB']
+    assert affinity.biomes.name == 'Biome'
+
+
+def test_biomes_are_calculated_lazily_and_cached():
+    affinity = BiomeAffinity(
+        affinity_scores=pd.DataFrame.from_records(
+            columns=('BiomeA', 'BiomeB'),
+            data=[(5.0, 4.5)]),
+        specificity_scores=pd.Series(
+            [0.02, 0.01],
+            ['BiomeA', 'BiomeB']),
+        decimals=1,
+        site='test')
+
+    assert affinity._biomes is None
+    assert affinity.biomes is affinity.biomes
+
+
+def test_apply_sequence_of_functions_to_affinity_scores():
+    affinity = BiomeAffinity(
+        affinity_scores=pd.DataFrame.from_records(
+            columns=('BiomeA', 'BiomeB'),
+            data=[
+                (5.0, 4.5),
+                (5.0, 4.0),
+            ]),
+        specificity_scores=pd.Series(
+            [0.02, 0.01],
+            ['BiomeA', 'BiomeB']),
+        decimals=1,
+        site='test')
+
+    funcs = [
+        lambda scores: scores * 2.04,
+        lambda scores: scores.sub(pd.Series([3.0, 0.0], ['BiomeA', 'BiomeB'])),
+    ]
+
+    new_affinity = affinity.apply(funcs)
+    chained = affinity.apply(funcs[0]).apply(funcs[1])
+
+    pd.testing.assert_frame_equal(new_affinity.scores, chained.scores)
+    assert new_affinity.scores.to_dict('records') == [
+        dict(BiomeA=pytest.approx(7.2), BiomeB=pytest.approx(9.2)),
+        dict(BiomeA=pytest.approx(7.2), BiomeB=pytest.approx(8.2))
+    ]
+    assert list(new_affinity.biomes) == ['BiomeB', 'BiomeB']
+
+
+def test_top_biomes():
+    affinity = BiomeAffinity(
+        affinity_scores=pd.DataFrame.from_records(
+            columns=('BiomeA', 'BiomeB', 'BiomeC', 'BiomeD'),
+            data=[
+                (5.0, 4.5, 1.0, 6.0),
+                (3.0, 3.0, 2.0, 0.0),
+                (0.0, 0.0, 0.0, 0.0),
+            ]),
+        specificity_scores=pd.Series(
+            [0.02, 0.01, 0.03, 0.04],
+            ['BiomeA', 'BiomeB', 'BiomeC', 'BiomeD']),
+        decimals=1,
+        site='test')
+
+    top = affinity.top_biomes(2)
+
+    assert list(top.columns) == ['Biome 1', 'Score 1', 'Biome 2', 'Score 2', 'Margin']
+    assert top.to_dict('records') == [
+        {'Biome 1': 'BiomeD', 'Score 1': 6.0, 'Biome 2': 'BiomeA', 'Score 2': 5.0, 'Margin': pytest.approx(1.0)},
+        {'Biome 1': 'BiomeB', 'Score 1': 3.0, 'Biome 2': 'BiomeA', 'Score 2': 3.0, 'Margin': pytest.approx(0.0)},
+        {'Biome 1': 'N/A', 'Score 1': 0.0, 'Biome 2': 'N/A', 'Score 2': 0.0, 'Margin': pytest.approx(0.0)},
+    ]
+    assert list(top['Biome 1']) == list(affinity.biomes)
+
+
+def test_top_biome_includes_margin():
+    affinity = BiomeAffinity(
+        affinity_scores=pd.DataFrame.from_records(
+            columns=('BiomeA', 'BiomeB', 'BiomeC'),
+            data=[(5.0, 4.5, 1.0)]),
+        specificity_scores=pd.Series(
+            [0.02, 0.01, 0.03],
+            ['BiomeA', 'BiomeB', 'BiomeC']),
+        decimals=1,
+        site='test')
+
+    top = affinity.top_biomes(1)
+
+    assert top.to_dict('records') == [
+        {'Biome 1': 'BiomeA', 'Score 1': 5.0, 'Margin': pytest.approx(0.5)},
+    ]
+
+
+def test_top_biomes_order_ties_like_biomes():
+    biomes = [f'b{i}' for i in range(11)]
+    rng = np.random.default_rng(0)
+
+    # Few distinct scores and taxa counts give many exact ties between the adjusted scores
+    affinity = BiomeAffinity(
+        affinity_scores=pd.DataFrame(rng.integers(0, 3, size=(500, len(biomes))).astype(float), columns=biomes),
+        specificity_scores=pd.Series(rng.integers(1, 3, size=len(biomes)) * 0.01, biomes),
+        decimals=1,
+        site='test')
+
+    top = affinity.top_biomes(2)
+
+    assert list(top['Biome 1']) == list(affinity.biomes)
+
+
+@pytest.mark.parametrize('use_path', [True, False])
+def test_save_and_load_biomization(tmp_path, use_path):
+    taxa_pfts = TaxaPftList(pd.DataFrame.from_records(
+            columns=('taxa', 'pft'),
+            data=[
+                ('taxa1', ['1', '3']),
+                ('taxa2', ['2', '3']),
+                ('taxa3', ['3']),
+                ('taxa4', ['1', '2', '3', '4'])
+                ]))
+
+    biome_pfts = BiomePftList(pd.DataFrame.from_records(
+            columns=('biome', 'pft'),
+            data=[
+                ('biome1', ['2', '4']),
+                ('biome2', ['1', '4'])
+                ]))
+
+    biomization = Biomization(taxa_pfts, biome_pfts)
+
+    if use_path:
+        path = tmp_path / 'biomization.npz'
+        biomization.save(path)
+        loaded = Biomization.load(path)
+    else:
+        buf = io.BytesIO()
+        biomization.save(buf)
+        buf.seek(0)
+        loaded = Biomization.load(buf)
+
+    assert loaded.taxa_biome_mapping is None
+    pd.testing.assert_frame_equal(loaded.taxa_biome_matrix, biomization.taxa_biome_matrix)
+    pd.testing.assert_series_equal(loaded._taxas_per_biome, biomization._taxas_per_biome)
+    assert loaded._specificity_decimals == biomization._specificity_decimals
+
+    samples = StabilizedPollenSamples(
+        samples=pd.DataFrame.from_dict(
+            orient='index',
+            columns=('taxa1', 'taxa2', 'taxa5'),
+            data=dict(row=[1.0, 2.0, 3.0])),
+        decimals=1)
+
+    pd.testing.assert_frame_equal(
+        loaded.get_biome_affinity(samples).scores,
+        biomization.get_biome_affinity(samples).scores)
+    assert loaded.get_unmapped_taxas(samples) == {'taxa5'}
+
+
+def test_column_alignment_is_cached_by_sample_columns():
+    biomization = batch_biomization()
+    site1, site2 = batch_sites()
+
+    same_layout = StabilizedPollenSamples(site1.samples * 2, decimals=1, site='site3')
+
+    assert biomization.get_unmapped_taxas(site1, site2, same_layout) == {'taxa4'}
+    assert len(biomization._alignments) == 2
+
+    alignment = biomization._get_alignment(site2.samples.columns)
+    assert list(alignment.sample_positions) == [0, 2]
+    assert list(alignment.taxa_positions) == [2, 1]
+    assert alignment.unmapped_taxas == {'taxa4'}
+
+    affinity = biomization.get_biome_affinity(same_layout)
+    assert len(biomization._alignments) == 2
+    assert affinity.scores.loc[20].to_dict() == dict(
+        biome1=pytest.approx(2), biome2=pytest.approx(6), biome3=pytest.approx(4))
+
+    # The matrix is only converted to the sample value type once
+    float_matrix = biomization._get_alignment(same_layout.samples.columns).matrices[np.dtype(np.float64)]
+    biomization.get_biome_affinity(site1)
+    assert biomization._get_alignment(site1.samples.columns).matrices[np.dtype(np.float64)] is float_matrix
+
+
+def test_column_alignment_cache_drops_least_recently_used(monkeypatch):
+    monkeypatch.setattr(brioche.biomization, 'ALIGNMENT_CACHE_SIZE', 2)
+    biomization = batch_biomization()
+
+    biomization._get_alignment(pd.Index(['taxa1']))
+    biomization._get_alignment(pd.Index(['taxa2']))
+    biomization._get_alignment(pd.Index(['taxa1']))
+    biomization._get_alignment(pd.Index(['taxa3']))
+
+    assert list(biomization._alignments) == [('taxa1',), ('taxa3',)]
+
+
+def test_float32_samples_are_scored_as_float64():
+    # Biome1 has one more taxa than biome2, so the tie-breaker favours
+    # biome2 by 1e-6 when both have the same score
+    taxa_pfts = TaxaPftMapping(pd.DataFrame(
+        [(f'taxa{i}', 1) for i in range(1001)] + [(f'other{i}', 2) for i in range(1000)],
+        columns=['taxa', 'pft']))
+    biome_pfts = BiomePftMapping(pd.DataFrame([('biome1', 1), ('biome2', 2)], columns=['biome', 'pft']))
+    biomization = Biomization(taxa_pfts, biome_pfts)
+
+    samples = pd.DataFrame([[24.86, 28.51, 8.22, 61.59]], columns=['taxa0', 'taxa1', 'taxa2', 'other0'])
+    compact = StabilizedPollenSamples(samples.astype('float32'), decimals=2, site='site1')
+
+    affinity = biomization.get_biome_affinity(compact)
+
+    assert list(affinity.scores.dtypes) == ['float64'] * 2
+    assert list(affinity.biomes) == ['biome2']
+    assert list(affinity.biomes) == list(biomization.get_biome_affinity(
+        StabilizedPollenSamples(samples, decimals=2, site='site1')).biomes)
+
+
+def bootstrap_counts():
+    return PollenCounts(
+        pd.DataFrame.from_dict(
+            orient='index',
+            columns=('taxa1', 'taxa2', 'taxa3', 'taxa4'),
+            data={
+                10: [20, 0, 0, 5],
+                20: [3, 4, 2, 1],
+                30: [0, 0, 0, 0],
+                40: [0, 1, 1, 0],
+            }),
+        site='site1')
+
+def test_bootstrap_biomes_match_scoring_each_replicate():
+    biomization = batch_biomization()
+    counts = bootstrap_counts()
+    thresholds = pd.Series({'taxa2': 1.0})
+
+    frequencies = biomization.get_bootstrap_biomes(
+        counts, replicates=50, default_threshold=0.5, thresholds=thresholds, seed=42, batch_size=16)
+
+    # Draw the same replicates and run them through the normal pipeline one at a time
+    samples = counts.samples
+    totals = samples.sum(axis=1).to_numpy()
+    proportions = samples.div(samples.sum(axis=1).where(lambda s: s != 0, 1), axis='index').to_numpy()
+    rng = np.random.default_rng(42)
+
+    expected = pd.DataFrame(0.0, index=samples.index, columns=['biome1', 'biome2', 'biome3', 'N/A'])
+    for start in range(0, 50, 16):
+        for draws in rng.multinomial(totals, proportions, size=(min(16, 50 - start), len(totals))):
+            replicate = PollenCounts(pd.DataFrame(draws, index=samples.index, columns=samples.columns))
+            stabilized = replicate.get_stabilized(default_threshold=0.5, thresholds=thresholds)
+            for depth, biome in biomization.get_biome_affinity(stabilized).biomes.items():
+                expected.loc[depth, biome] += 1 / 50
+
+    pd.testing.assert_frame_equal(frequencies, expected)
+    assert frequencies.loc[10].to_dict() == dict(biome1=1.0, biome2=0.0, biome3=0.0, **{'N/A': 0.0})
+    assert frequencies.loc[30, 'N/A'] == 1.0
+    assert np.allclose(frequencies.sum(axis=1), 1.0)
+
+
+def test_bootstrap_biomes_are_reproducible_with_seed():
+    biomization = batch_biomization()
+    counts = bootstrap_counts()
+
+    first = biomization.get_bootstrap_biomes(counts, replicates=40, seed=1, batch_size=7)
+    second = biomization.get_bootstrap_biomes(counts, replicates=40, seed=1, batch_size=7)
+
+    pd.testing.assert_frame_equal(first, second)
+
+
+def test_bootstrap_biomes_require_counts():
+    biomization = batch_biomization()
+    site1, _ = batch_sites()
+
+    with pytest.raises(ValueError):
+        biomization.get_bootstrap_biomes(site1)
+
+
+def sensitivity_mappings():
+    taxa_pfts = TaxaPftMatrix(pd.DataFrame.from_records(
+            columns=('taxa', 1, 2, 3, 4),
+            data=[
+                ('taxa1', 1, 1, 0, 0),
+                ('taxa2', 0, 1, 1, 0),
+                ('taxa3', 0, 0, 1, 1),
+                ('taxa4', 0, 0, 0, 1),
+                ('taxa5', 1, 0, 0, 1),
+                ]))
+
+    biome_pfts = BiomePftMatrix(pd.DataFrame.from_records(
+            columns=('biome', 1, 2, 3, 4),
+            data=[
+                ('biome1', 1, 0, 0, 0),
+                ('biome2', 0, 1, 1, 0),
+                ('biome3', 0, 0, 1, 1),
+                ('biome4', 1, 1, 0, 1),
+                ]))
+
+    return taxa_pfts, biome_pfts
+
+def sensitivity_samples():
+    return StabilizedPollenSamples(
+        samples=pd.DataFrame.from_dict(
+            orient='index',
+            columns=('taxa1', 'taxa2', 'taxa3', 'taxa6'),
+            data={
+                10: [2.0, 1.0, 0.0, 4.0],
+                20: [1.0, 1.0, 1.0, 0.0],
+                30: [0.0, 0.0, 3.0, 0.0],
+                40: [0.0, 0.0, 0.0, 5.0],
+                50: [1.5, 0.0, 1.5, 0.0],
+            }),
+        decimals=1,
+        site='site1')
+
+@pytest.mark.parametrize('by', ['taxa', 'pft'])
+def test_leave_one_out_biomes_match_rebuilt_biomization(by):
+    taxa_pfts, biome_pfts = sensitivity_mappings()
+    samples = sensitivity_samples()
+    biomization = Biomization(taxa_pfts, biome_pfts)
+
+    result = biomization.get_leave_one_out_biomes(samples, by=by)
+
+    if by == 'taxa':
+        assert list(result.columns) == ['taxa1', 'taxa2', 'taxa3', 'taxa4', 'taxa5']
+    else:
+        assert list(result.columns) == [1, 2, 3, 4]
+
+    for name in result.columns:
+        reduced = Biomization(
+            TaxaPftMapping(taxa_pfts.mapping[taxa_pfts.mapping[by] != name]),
+            BiomePftMapping(biome_pfts.mapping[biome_pfts.mapping['pft'] != name]))
+        expected = reduced.get_biome_affinity(samples).biomes
+
+        assert list(result[name].astype(str)) == list(expected.astype(str)), name
+
+
+def test_leave_one_out_pfts_requires_taxa_biome_mapping(tmp_path):
+    biomization = Biomization(*sensitivity_mappings())
+    biomization.save(tmp_path / 'biomization.npz')
+    loaded = Biomization.load(tmp_path / 'biomization.npz')
+
+    pd.testing.assert_frame_equal(
+        loaded.get_leave_one_out_biomes(sensitivity_samples()),
+        biomization.get_leave_one_out_biomes(sensitivity_samples()))
+
+    with pytest.raises(ValueError):
+        loaded.get_leave_one_out_biomes(sensitivity_samples(), by='pft')
+
+
+def changed_batch_biomization():
+    taxa_pfts = TaxaPftMatrix(pd.DataFrame.from_records(
+            columns=('taxa', 1, 2, 3, 4),
+            data=[
+                ('taxa1', 1, 1, 0, 0),
+                ('taxa2', 1, 0, 1, 0),
+                ('taxa3', 0, 0, 1, 0),
+                ('taxa5', 0, 0, 0, 1),
+                ]))
+
+    biome_pfts = BiomePftMatrix(pd.DataFrame.from_records(
+            columns=('biome', 1, 2, 3, 4),
+            data=[
+                ('biome1', 1, 0, 0, 0),
+                ('biome2', 0, 1, 0, 0),
+                ('biome4', 0, 0, 0, 1)
+                ]))
+
+    return Biomization(taxa_pfts, biome_pfts)
+
+def test_get_mapping_changes():
+    changes = changed_batch_biomization().get_mapping_changes(batch_biomization())
+
+    assert list(changes.added.itertuples(index=False, name=None)) == [
+        ('taxa2', 'biome1'), ('taxa5', 'biome4')]
+    assert list(changes.removed.itertuples(index=False, name=None)) == [
+        ('taxa2', 'biome2'), ('taxa2', 'biome3'), ('taxa3', 'biome3')]
+    assert set(changes.taxas) == {'taxa2', 'taxa3', 'taxa5'}
+    assert set(changes.biomes) == {'biome1', 'biome2', 'biome3', 'biome4'}
+
+def test_update_biome_affinity_matches_new_biomization():
+    previous = batch_biomization()
+    biomization = changed_batch_biomization()
+    changes = biomization.get_mapping_changes(previous)
+
+    unaffected = StabilizedPollenSamples(
+        samples=pd.DataFrame.from_dict(
+            orient='index',
+            columns=('taxa1', 'taxa4'),
+            data={10: [2.0, 1.0], 20: [0.0, 3.0]}),
+        decimals=1,
+        site='site3')
+
+    for site in batch_sites() + [unaffected]:
+        old_scores = previous.get_biome_affinity(site).scores
+
+        updated = biomization.update_biome_affinity(site, old_scores, changes)
+        expected = biomization.get_biome_affinity(site)
+
+        pd.testing.assert_frame_equal(updated.scores, expected.scores)
+        pd.testing.assert_series_equal(updated.biomes, expected.biomes)
+        pd.testing.assert_series_equal(updated._specificity_scores, expected._specificity_scores)
+
+def test_update_biome_affinity_requires_scores_for_the_samples():
+    previous = batch_biomization()
+    biomization = changed_batch_biomization()
+    site1, site2 = batch_sites()
+
+    with pytest.raises(ValueError):
+        biomization.update_biome_affinity(site1, previous.get_biome_affinity(site2).scores,
+                                          biomization.get_mapping_changes(previous))
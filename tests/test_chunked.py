@@ -0,0 +1,115 @@
+# Copyright 2020 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Open source under the MIT license (see LICENSE)
+
+# pylint: disable=missing-function-docstring missing-module-docstring import-error
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from brioche import \
+    BiomePftMatrix, TaxaPftMatrix, \
+    Biomization, PollenCounts, PollenPercentages, \
+    biomize_csv_in_chunks
+
+@pytest.fixture
+def biomization():
+    taxa_pfts = TaxaPftMatrix(pd.DataFrame.from_records(
+            columns=('taxa', 1, 2, 3),
+            data=[
+                ('taxa1', 1, 1, 0),
+                ('taxa2', 0, 1, 1),
+                ('taxa3', 0, 0, 1),
+                ]))
+
+    biome_pfts = BiomePftMatrix(pd.DataFrame.from_records(
+            columns=('biome', 1, 2, 3),
+            data=[
+                ('biome1', 1, 0, 0),
+                ('biome2', 0, 1, 0),
+                ('biome3', 0, 0, 1)
+                ]))
+
+    return Biomization(taxa_pfts, biome_pfts)
+
+@pytest.mark.parametrize('chunk_rows', [1, 7, 100])
+def test_chunked_output_is_the_same_as_whole_file(tmp_path, biomization, chunk_rows):
+    rng = np.random.default_rng(chunk_rows)
+    counts = pd.DataFrame(rng.integers(0, 30, size=(25, 4)),
+                          columns=['taxa1', 'taxa2', 'taxa3', 'taxa4'],
+                          index=pd.Index(range(0, 250, 10), name='depth'))
+    counts.iloc[5] = 0
+
+    sample_path = tmp_path / 'site.csv'
+    counts.to_csv(sample_path)
+
+    # Process the whole file at once
+    sample = PollenCounts.read_csv(sample_path, site='site')
+    stabilized = sample.get_stabilized(default_threshold=0.5, decimals=2)
+    affinity = biomization.get_biome_affinity(stabilized)
+
+    sample.get_percentages(2).to_csv(tmp_path / 'percentages.csv', decimals=2)
+    stabilized.to_csv(tmp_path / 'stabilized.csv')
+    affinity.biomes_to_csv(tmp_path / 'biomes.csv')
+    affinity.scores_to_csv(tmp_path / 'scores.csv')
+    affinity.top_biomes_to_csv(tmp_path / 'top_biomes.csv', k=2)
+
+    unmapped = biomize_csv_in_chunks(
+        biomization, PollenCounts, sample_path, chunk_rows,
+        tmp_path / 'chunked_biomes.csv', tmp_path / 'chunked_scores.csv',
+        percentages_path=tmp_path / 'chunked_percentages.csv',
+        stabilized_path=tmp_path / 'chunked_stabilized.csv',
+        top_biomes_path=tmp_path / 'chunked_top_biomes.csv', top_biomes=2,
+        default_threshold=0.5, decimals=2, site='site')
+
+    assert unmapped == {'taxa4'}
+
+    for name in ('percentages', 'stabilized', 'biomes', 'scores', 'top_biomes'):
+        expected = (tmp_path / f'{name}.csv').read_text()
+        assert (tmp_path / f'chunked_{name}.csv').read_text() == expected
+
+@pytest.mark.parametrize('sample_class, values', [
+    (PollenCounts, ['1,4,45', '3,0,7', '5,5,5', '0,2,9']),
+    (PollenPercentages, ['25,25,50', '10,40,50', '20.5,30,49.5', '0,0,0']),
+])
+def test_chunked_output_uses_the_same_types_for_all_chunks(tmp_path, biomization, sample_class, values):
+    # The first chunk only has integer depths (and values), the later ones floats
+    sample_path = tmp_path / 'site.csv'
+    sample_path.write_text('depth,taxa1,taxa2,taxa3\n' + ''.join(
+        f'{depth},{row}\n' for depth, row in zip(['10', '20', '30.5', '40'], values)))
+
+    sample = sample_class.read_csv(sample_path, site='site')
+    stabilized = sample.get_stabilized(decimals=2)
+    affinity = biomization.get_biome_affinity(stabilized)
+
+    sample.get_percentages(2).to_csv(tmp_path / 'percentages.csv', decimals=2)
+    stabilized.to_csv(tmp_path / 'stabilized.csv')
+    affinity.biomes_to_csv(tmp_path / 'biomes.csv')
+    affinity.scores_to_csv(tmp_path / 'scores.csv')
+
+    biomize_csv_in_chunks(
+        biomization, sample_class, sample_path, 2,
+        tmp_path / 'chunked_biomes.csv', tmp_path / 'chunked_scores.csv',
+        percentages_path=tmp_path / 'chunked_percentages.csv',
+        stabilized_path=tmp_path / 'chunked_stabilized.csv',
+        decimals=2, site='site')
+
+    assert (tmp_path / 'biomes.csv').read_text().startswith('depth,Biome\n10.0,')
+
+    for name in ('percentages', 'stabilized', 'biomes', 'scores'):
+        expected = (tmp_path / f'{name}.csv').read_text()
+        assert (tmp_path / f'chunked_{name}.csv').read_text() == expected
+
+def test_chunked_percentages_without_optional_outputs(tmp_path, biomization):
+    sample_path = tmp_path / 'site.csv'
+    sample_path.write_text('depth;taxa1;taxa3\n10;25.0;75.0\n20;0.0;0.0\n')
+
+    unmapped = biomize_csv_in_chunks(
+        biomization, PollenPercentages, sample_path, 1,
+        tmp_path / 'biomes.csv', tmp_path / 'scores.csv',
+        decimals=1, sep=';')
+
+    assert unmapped == set()
+    assert (tmp_path / 'biomes.csv').read_text() == 'depth;Biome\n10;biome3\n20;N/A\n'
+    assert (tmp_path / 'scores.csv').read_text() == 'depth;biome1;biome2;biome3\n10;5.0;5.0;8.7\n20;0.0;0.0;0.0\n'
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['biomes.csv', 'scores.csv', 'site.csv']
@@ -0,0 +1,108 @@
+# Copyright 2020 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Open source under the MIT license (see LICENSE)
+
+# pylint: disable=missing-function-docstring missing-module-docstring import-error
+
+import io
+import json
+import tracemalloc
+
+import pandas as pd
+
+from brioche import Profile, recording, set_recorder, PollenCounts
+from brioche.instrumentation import get_recorder, stage
+
+def test_stage_without_recorder_does_nothing():
+    assert get_recorder() is None
+
+    with stage('test') as info:
+        info['frame'] = pd.DataFrame([[1, 2]])
+
+
+def test_stage_records_site_and_frame_shape():
+    profile = Profile()
+
+    with recording(profile):
+        with stage('first', site='site1', frame=pd.DataFrame([[1, 2, 3]])):
+            pass
+        with stage('second') as info:
+            info['frame'] = pd.DataFrame([[1], [2]])
+
+    assert get_recorder() is None
+
+    first, second = profile.stages
+    assert first['stage'] == 'first'
+    assert first['site'] == 'site1'
+    assert (first['rows'], first['columns']) == (1, 3)
+    assert first['wall_time'] >= 0
+    assert 'allocated_bytes' not in first
+
+    assert second['stage'] == 'second'
+    assert second['site'] is None
+    assert (second['rows'], second['columns']) == (2, 1)
+
+
+def test_stage_records_allocated_bytes_when_tracing():
+    profile = Profile()
+
+    tracemalloc.start()
+    try:
+        with recording(profile):
+            with stage('allocate'):
+                data = bytearray(1000000)
+    finally:
+        tracemalloc.stop()
+
+    assert len(data) == 1000000
+    assert profile.stages[0]['allocated_bytes'] >= 1000000
+
+
+def test_stage_records_peak_of_freed_allocations():
+    profile = Profile()
+
+    tracemalloc.start()
+    try:
+        with recording(profile):
+            with stage('outer'):
+                with stage('inner'):
+                    data = bytearray(10000000)
+                    del data
+
+                with stage('after'):
+                    pass
+    finally:
+        tracemalloc.stop()
+
+    records = {r['stage']: r for r in profile.stages}
+    assert records['inner']['allocated_bytes'] >= 10000000
+    assert records['outer']['allocated_bytes'] >= 10000000
+    assert 0 <= records['after']['allocated_bytes'] < 10000000
+
+
+def test_set_recorder_returns_previous():
+    records = []
+    assert set_recorder(records.append) is None
+    try:
+        with stage('test'):
+            pass
+    finally:
+        assert set_recorder(None) == records.append
+
+    assert [r['stage'] for r in records] == ['test']
+
+
+def test_profile_reports_sample_stages_as_json():
+    counts = PollenCounts(pd.DataFrame([[1, 3], [2, 2]], columns=['taxa1', 'taxa2']), site='site1')
+
+    profile = Profile()
+    with recording(profile):
+        counts.get_percentages()
+        counts.get_stabilized()
+
+    buf = io.StringIO()
+    profile.to_json(buf)
+    report = json.loads(buf.getvalue())
+
+    assert [r['stage'] for r in report['stages']] == ['get_percentages', 'get_stabilized']
+    assert all(r['site'] == 'site1' for r in report['stages'])
+    assert report['totals']['get_stabilized']['count'] == 1
@@ -125,3 +125,36 @@ def test_read_taxa_pft_google_sheet():
         dict(pft=2, taxa='Taxa B')
     ]
 
+
+
+@pytest.mark.parametrize('list_class', [BiomePftList, TaxaPftList])
+def test_read_csv_gives_the_same_mapping_as_exploding_lists(list_class):
+    csv = '''Key C,3,,4
+Key A,1,2,
+Key B,,,
+Key A,5,,
+'''
+    key_name = list_class.key_name
+
+    raw = pd.read_csv(io.StringIO(csv), dtype=str, header=None)
+    expected = list_class(raw.apply(
+        lambda row: pd.Series([row.iloc[0], row.iloc[1:].dropna().to_list()], index=[key_name, 'pft']),
+        axis='columns'))
+
+    result = list_class.read_csv(io.StringIO(csv))
+
+    assert type(result) == list_class
+    pd.testing.assert_frame_equal(result.mapping, expected.mapping)
+
+
+@pytest.mark.parametrize('list_class', [BiomePftList, TaxaPftList])
+def test_create_pft_list_from_mapping(list_class):
+    mapping = pd.DataFrame({list_class.key_name: ['Key A', 'Key A'], 'pft': ['1', '2']})
+
+    assert list_class(mapping=mapping).mapping is mapping
+
+    with pytest.raises(ValueError):
+        list_class()
+
+    with pytest.raises(ValueError):
+        list_class(pd.DataFrame({list_class.key_name: ['Key A'], 'pft': [['1']]}), mapping=mapping)
@@ -3,10 +3,13 @@
 
 # pylint: disable=missing-function-docstring missing-module-docstring import-error
 
+import io
 import pytest
+import numpy as np
 import pandas as pd
 
-from brioche import PollenCounts, PollenPercentages, StabilizedPollenSamples
+from brioche import PollenCounts, PollenPercentages, StabilizedPollenSamples, \
+    read_thresholds_csv, stabilize_percentages
 
 def test_get_taxas():
     counts = PollenCounts(pd.DataFrame.from_records(
@@ -246,3 +249,264 @@ def test_apply_function_to_stabilized_samples():
 
     assert new_stab.site == stab.site
     assert new_stab.decimals == stab.decimals
+
+
+def test_calculate_percentages_from_counts_with_missing_values():
+    counts = PollenCounts(pd.DataFrame.from_records(
+        columns=('TaxaA', 'TaxaB', 'TaxaC'),
+        data=[
+            (5, None, 15),
+            (None, None, None),
+        ]))
+
+    result = counts.get_percentages().samples.to_dict('records')
+
+    assert result == [
+        dict(TaxaA=25.0, TaxaB=0.0, TaxaC=75.0),
+        dict(TaxaA=0.0, TaxaB=0.0, TaxaC=0.0),
+    ]
+
+
+@pytest.mark.parametrize(('samples_class', 'expected_value'), [
+    (PollenCounts, 16.67),
+    (PollenPercentages, 1.0)])
+def test_calculate_float32_percentages(samples_class, expected_value):
+    samples = samples_class(pd.DataFrame.from_records(
+        columns=('TaxaA', 'TaxaB'),
+        data=[
+            (1, 5),
+            (0, 0),
+        ]))
+
+    percentages = samples.get_percentages(decimals=2, dtype=np.float32)
+
+    assert list(percentages.samples.dtypes) == [np.float32, np.float32]
+    assert percentages.samples.iat[0, 0] == pytest.approx(expected_value)
+
+
+@pytest.mark.parametrize('decimals', [0, 1, 2, 3])
+def test_get_stabilized_matches_stepwise_calculation(decimals):
+    rng = np.random.default_rng(decimals)
+    counts = PollenCounts(pd.DataFrame(rng.integers(0, 50, size=(40, 12))))
+    counts.samples.iloc[3] = 0
+
+    percentages = counts.get_percentages().samples
+    expected = (percentages
+                    .sub(0.5)
+                    .clip(lower=0)
+                    .apply(np.sqrt)
+                    .round(decimals))
+
+    stabilized = counts.get_stabilized(default_threshold=0.5, decimals=decimals)
+
+    pd.testing.assert_frame_equal(stabilized.samples, expected)
+
+
+def test_stabilize_percentages_in_place():
+    values = np.array([[25.5, 0.2], [1.1, 0.5]])
+
+    result = stabilize_percentages(values, 0.5, 2, out=values)
+
+    assert result is values
+    assert values.tolist() == [[5.0, 0.0], [0.77, 0.0]]
+
+
+def test_get_stabilized_using_per_taxa_thresholds():
+    percentages = PollenPercentages(pd.DataFrame.from_records(
+        columns=('TaxaA', 'TaxaB', 'TaxaC'),
+        data=[
+            (25.5, 10.0, 1.5),
+            (1.0, 5.0, 100.0),
+        ]))
+
+    stabilized = percentages.get_stabilized(
+        default_threshold=1.0, decimals=2,
+        thresholds=dict(TaxaA=0.5, TaxaB=6.0, TaxaD=2.0))
+
+    result = stabilized.samples.to_dict('records')
+
+    assert result == [
+        dict(TaxaA=pytest.approx(5.0), TaxaB=pytest.approx(2.0), TaxaC=pytest.approx(0.71)),
+        dict(TaxaA=pytest.approx(0.71), TaxaB=pytest.approx(0.0), TaxaC=pytest.approx(9.95)),
+    ]
+
+
+def test_read_thresholds_csv():
+    thresholds = read_thresholds_csv(io.StringIO('TaxaA,0.5\nTaxaB,2\n'))
+
+    assert thresholds.to_dict() == dict(TaxaA=0.5, TaxaB=2.0)
+
+
+def test_read_thresholds_csv_with_duplicate_taxas():
+    with pytest.raises(ValueError, match='TaxaA'):
+        read_thresholds_csv(io.StringIO('TaxaA,0.5\nTaxaB,2\nTaxaA,1\n'))
+
+
+@pytest.mark.parametrize('samples_class', [PollenCounts, PollenPercentages])
+def test_parquet_round_trip(tmp_path, samples_class):
+    pytest.importorskip('pyarrow')
+
+    samples = samples_class(pd.DataFrame.from_records(
+        columns=('Depth', 'TaxaA', 'TaxaB'),
+        data=[
+            (10, 5, 15),
+            (20, 1, 0),
+        ]).set_index('Depth'))
+
+    path = tmp_path / 'samples.parquet'
+    samples.to_parquet(path)
+    result = samples_class.read_parquet(path, site='test')
+
+    assert type(result) == samples_class
+    assert result.site == 'test'
+    pd.testing.assert_frame_equal(result.samples, samples.samples)
+
+
+def test_stabilized_parquet_round_trip(tmp_path):
+    pytest.importorskip('pyarrow')
+
+    stabilized = StabilizedPollenSamples(pd.DataFrame.from_records(
+        columns=('TaxaA', 'TaxaB'),
+        data=[
+            (1.25, 3.5),
+        ]),
+        decimals=2)
+
+    path = tmp_path / 'stabilized.parquet'
+    stabilized.to_parquet(path)
+    result = StabilizedPollenSamples.read_parquet(path, decimals=2, site='test')
+
+    assert type(result) == StabilizedPollenSamples
+    assert result.decimals == 2
+    assert result.site == 'test'
+    pd.testing.assert_frame_equal(result.samples, stabilized.samples)
+
+
+def test_read_compact_counts():
+    counts = PollenCounts.read_csv(io.StringIO('Depth,TaxaA,TaxaB\n10,5,300\n20,1,0\n'), dtype='compact')
+
+    assert list(counts.samples.dtypes) == [np.uint16, np.uint16]
+    assert counts.samples.to_dict('index') == {
+        10: dict(TaxaA=5, TaxaB=300),
+        20: dict(TaxaA=1, TaxaB=0),
+    }
+
+
+def test_read_compact_percentages_from_google_sheet():
+    percentages = PollenPercentages.read_google_sheet(DummyWorksheet('test',
+        ('Level', 'foo', 'bar'),
+        ('a', 14, ''),
+        ('b', '', 13.2)
+    ), dtype='compact')
+
+    assert list(percentages.samples.dtypes) == [np.float32, np.float32]
+
+
+@pytest.mark.parametrize(('decimals', 'expected_dtype'), [
+    (2, np.float32),
+    (3, np.float32),
+    (4, np.float64)])
+def test_compact_stabilized_samples_match_float64(decimals, expected_dtype):
+    # Enough values that some of them end up close to halfway between two decimals
+    rng = np.random.default_rng(decimals)
+    csv = pd.DataFrame(rng.integers(0, 2000, size=(2000, 100))).to_csv()
+
+    counts = PollenCounts.read_csv(io.StringIO(csv))
+    compact_counts = PollenCounts.read_csv(io.StringIO(csv), dtype='compact')
+    assert compact_counts.samples.dtypes.iloc[0] == np.uint16
+
+    percentages = counts.get_percentages(decimals)
+    compact_percentages = compact_counts.get_percentages(decimals, dtype='compact')
+    assert compact_percentages.samples.dtypes.iloc[0] == expected_dtype
+
+    stabilized = counts.get_stabilized(default_threshold=0.5, decimals=decimals)
+    compact_stabilized = compact_counts.get_stabilized(default_threshold=0.5, decimals=decimals, dtype='compact')
+    assert compact_stabilized.samples.dtypes.iloc[0] == expected_dtype
+
+    def to_csv(samples):
+        buf = io.StringIO()
+        samples.to_csv(buf, decimals=decimals)
+        return buf.getvalue()
+
+    assert to_csv(compact_percentages) == to_csv(percentages)
+    assert to_csv(compact_stabilized) == to_csv(stabilized)
+
+
+class DummySpreadsheet:
+    """Mimics a gspread Spreadsheet, including the Sheets API leaving out empty cells at the end of rows."""
+
+    def __init__(self, *worksheets):
+        self._worksheets = worksheets
+        self.requests = []
+
+    def worksheets(self):
+        return list(self._worksheets)
+
+    def values_batch_get(self, ranges, params=None):
+        self.requests.append((ranges, params))
+        by_range = {"'{}'".format(ws.title.replace("'", "''")): ws for ws in self._worksheets}
+
+        def trim(row):
+            row = list(row)
+            while row and row[-1] == '':
+                row.pop()
+            return row
+
+        return dict(valueRanges=[
+            dict(range=r, values=[trim(row) for row in by_range[r]._values])
+            for r in ranges
+        ])
+
+def test_read_counts_from_google_workbook():
+    spreadsheet = DummySpreadsheet(
+        DummyWorksheet('site1',
+            ('Level', 'foo', 'bar'),
+            ('a', 14, ''),
+            ('b', '', 13.2)),
+        DummyWorksheet("site 2's",
+            ('Depth', 'foo', 'Age', 'baz'),
+            (100, 14, 158, ''),
+            (200, '', 354, 7)))
+
+    counts = PollenCounts.read_google_workbook(spreadsheet)
+
+    assert len(spreadsheet.requests) == 1
+    assert spreadsheet.requests[0] == (["'site1'", "'site 2''s'"], dict(valueRenderOption='UNFORMATTED_VALUE'))
+
+    assert [c.site for c in counts] == ['site1', "site 2's"]
+    assert counts[0].samples.to_dict('index') == dict(
+        a=dict(foo=14, bar=0),
+        b=dict(foo=0, bar=13)
+    )
+    assert counts[1].samples.to_dict('index') == {
+        100: dict(foo=14, Age=158, baz=0),
+        200: dict(foo=0, Age=354, baz=7),
+    }
+
+def test_read_workbook_gives_the_same_samples_as_worksheets():
+    worksheets = [
+        DummyWorksheet('site1',
+            ('Depth', 'foo', 'Age', 'bar'),
+            (100, 14, 158, ''),
+            (200, '', 354, 13.2)),
+        DummyWorksheet('site2',
+            ('Depth', 'foo', 'Age', 'bar'),
+            (300, 1, 400, 2.5)),
+    ]
+
+    stabilized = StabilizedPollenSamples.read_google_workbook(
+        DummySpreadsheet(*worksheets), decimals=1, index_col=[0, 2], worksheets=worksheets[1:])
+
+    assert len(stabilized) == 1
+    expected = StabilizedPollenSamples.read_google_sheet(worksheets[1], decimals=1, index_col=[0, 2])
+
+    assert stabilized[0].site == 'site2'
+    assert stabilized[0].decimals == 1
+    pd.testing.assert_frame_equal(stabilized[0].samples, expected.samples)
+
+def test_raise_exception_for_duplicate_columns_in_google_workbook():
+    with pytest.raises(ValueError, match=r'^Duplicate columns in test: .*foo'):
+        PollenCounts.read_google_workbook(DummySpreadsheet(DummyWorksheet('test',
+            ('Depth', 'foo', 'bar', 'foo'),
+            (10, 14, 0, 0),
+        )))
@@ -3,9 +3,15 @@
 
 # pylint: disable=missing-function-docstring missing-module-docstring import-error
 
+import os
+import json
+import stat
+
 import pytest
 import pandas as pd
 
+import brioche.tool
+from brioche import Biomization
 from brioche.tool import main
 
 SEPS = pytest.mark.parametrize('sep', [',', ';'])
@@ -122,6 +128,368 @@ def test_stabilzed_pollen_samples(tmp_path, sep):
         (10, 'biome2'))
 
 
+@SEPS
+def test_per_taxa_thresholds(tmp_path, sep):
+    taxas = write_taxas(tmp_path, sep)
+    biomes = write_biomes(tmp_path, sep)
+
+    thresholds = tmp_path / 'thresholds.csv'
+    thresholds.write_text(f'taxa1{sep}0.0\ntaxa3{sep}20.0\n')
+
+    site1 = write_samples(tmp_path, 'site1', sep,
+        ('depth', 'taxa1', 'taxa2', 'taxa3'),
+        (10, 1, 9, 90))
+
+    main(['--decimals=3',
+        '--separator', sep,
+        '--default-threshold=10.5',
+        '--thresholds', str(thresholds),
+        '--save-stabilized',
+        '--type=percentages',
+        '--taxas', taxas,
+        '--biomes', biomes,
+        site1])
+
+    assert read_csv(tmp_path / 'site1_stabilized.csv') == expected_csv(sep,
+        ('depth', 'taxa1', 'taxa2', 'taxa3'),
+        (10, '1.000', '0.000', '8.367'))
+
+
+def test_parquet_output_and_input(tmp_path):
+    pytest.importorskip('pyarrow')
+
+    taxas = write_taxas(tmp_path, ',')
+    biomes = write_biomes(tmp_path, ',')
+
+    site1 = write_samples(tmp_path, 'site1', ',',
+        ('depth', 'taxa1', 'taxa2', 'taxa3'),
+        (10, 1, 4, 45))
+
+    main(['--decimals=1',
+        '--format=parquet',
+        '--save-stabilized',
+        '--taxas', taxas,
+        '--biomes', biomes,
+        site1])
+
+    stabilized = pd.read_parquet(tmp_path / 'site1_stabilized.parquet')
+    assert stabilized.to_dict('index') == {10: dict(taxa1=1.2, taxa2=2.7, taxa3=9.5)}
+
+    scores = pd.read_parquet(tmp_path / 'site1_scores.parquet')
+    assert scores.to_dict('index') == {10: dict(biome1=1.2, biome2=2.7, biome3=9.5)}
+
+    biomes_result = pd.read_parquet(tmp_path / 'site1_biomes.parquet')
+    assert biomes_result.to_dict('index') == {10: dict(Biome='biome3')}
+
+    # Use the stabilized parquet file as input to get CSV results
+    main(['--decimals=1',
+        '--type=stabilized',
+        '--taxas', taxas,
+        '--biomes', biomes,
+        str(tmp_path / 'site1_stabilized.parquet')])
+
+    assert read_csv(tmp_path / 'site1_stabilized_scores.csv') == expected_csv(',',
+        ('depth', 'biome1', 'biome2', 'biome3'),
+        (10, '1.2', '2.7', '9.5'))
+
+
+def test_top_biomes_output(tmp_path):
+    taxas = write_taxas(tmp_path, ',')
+    biomes = write_biomes(tmp_path, ',')
+
+    site1 = write_samples(tmp_path, 'site1', ',',
+        ('depth', 'taxa1', 'taxa2', 'taxa3'),
+        (10, 1, 4, 45))
+
+    main(['--decimals=1',
+        '--top-biomes=2',
+        '--taxas', taxas,
+        '--biomes', biomes,
+        site1])
+
+    assert read_csv(tmp_path / 'site1_top_biomes.csv') == expected_csv(',',
+        ('depth', 'Biome 1', 'Score 1', 'Biome 2', 'Score 2', 'Margin'),
+        (10, 'biome3', '9.5', 'biome2', '2.7', '6.8'))
+
+
+def test_biomization_cache(tmp_path, monkeypatch):
+    taxas = write_taxas(tmp_path, ',')
+    biomes = write_biomes(tmp_path, ',')
+    cache_dir = tmp_path / 'cache'
+
+    site1 = write_samples(tmp_path, 'site1', ',',
+        ('depth', 'taxa1', 'taxa2', 'taxa3'),
+        (10, 1, 4, 45))
+
+    def run():
+        main(['--decimals=1',
+            '--cache-dir', str(cache_dir),
+            '--taxas', taxas,
+            '--biomes', biomes,
+            site1])
+
+        return read_csv(tmp_path / 'site1_scores.csv')
+
+    scores = run()
+    assert len(list(cache_dir.glob('*.npz'))) == 1
+
+    # The second run must load the cached biomization instead of parsing the mappings
+    build_biomization = brioche.tool.build_biomization
+    monkeypatch.setattr(brioche.tool, 'build_biomization', None)
+    assert run() == scores
+
+    # Changing a mapping file must create a new cache file
+    monkeypatch.setattr(brioche.tool, 'build_biomization', build_biomization)
+    with open(biomes, 'at') as f:
+        f.write('biome4,1\n')
+
+    assert run() != scores
+    assert len(list(cache_dir.glob('*.npz'))) == 2
+
+
+def test_biomization_cache_files_use_default_file_mode(tmp_path):
+    taxas = write_taxas(tmp_path, ',')
+    biomes = write_biomes(tmp_path, ',')
+    cache_dir = tmp_path / 'cache'
+    site1 = write_samples(tmp_path, 'site1', ',', ('depth', 'taxa1'), (10, 1))
+
+    umask = os.umask(0o022)
+    try:
+        main(['--cache-dir', str(cache_dir), '--taxas', taxas, '--biomes', biomes, site1])
+    finally:
+        os.umask(umask)
+
+    cache_file, = cache_dir.glob('*.npz')
+    assert stat.S_IMODE(cache_file.stat().st_mode) == 0o644
+
+
+def test_broken_biomization_cache_file_is_rebuilt(tmp_path):
+    taxas = write_taxas(tmp_path, ',')
+    biomes = write_biomes(tmp_path, ',')
+    cache_dir = tmp_path / 'cache'
+    site1 = write_samples(tmp_path, 'site1', ',', ('depth', 'taxa1'), (10, 1))
+
+    def run():
+        main(['--cache-dir', str(cache_dir), '--taxas', taxas, '--biomes', biomes, site1])
+        return read_csv(tmp_path / 'site1_scores.csv')
+
+    scores = run()
+    cache_file, = cache_dir.glob('*.npz')
+    cache_file.write_bytes(b'not a cache file')
+
+    assert run() == scores
+    assert list(Biomization.load(cache_file).taxa_biome_sparse_matrix.biomes) == ['biome1', 'biome2', 'biome3']
+
+
+def test_chunked_sites_give_the_same_output(tmp_path, capsys):
+    taxas = write_taxas(tmp_path, ';')
+    biomes = write_biomes(tmp_path, ';')
+
+    site1 = write_samples(tmp_path, 'site1', ';',
+        ('depth', 'age', 'taxa1', 'taxa2', 'taxa4'),
+        *[(i * 10, i * 100, i % 3, 4 + i, 45 - i) for i in range(10)])
+
+    def run(*extra_args):
+        main(['--separator', ';',
+            '--index', '0', '--index', '1',
+            '--save-percentages',
+            '--save-stabilized',
+            '--top-biomes', '2',
+            '--taxas', taxas,
+            '--biomes', biomes,
+            site1] + list(extra_args))
+
+        output = capsys.readouterr().out
+        results = {
+            name: read_csv(tmp_path / f'site1_{name}.csv')
+            for name in ('percentages', 'stabilized', 'scores', 'biomes', 'top_biomes')
+        }
+        return output, results
+
+    chunked_output, chunked_results = run('--chunk-rows', '3')
+    output, results = run()
+
+    assert chunked_results == results
+
+    # The unmapped taxas are reported after processing the files
+    assert chunked_output.endswith('taxa4\n\n')
+    assert sorted(chunked_output.splitlines()) == sorted(output.splitlines())
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_profile_reports_stages_per_site(tmp_path, jobs):
+    taxas = write_taxas(tmp_path, ',')
+    biomes = write_biomes(tmp_path, ',')
+
+    sites = [
+        write_samples(tmp_path, f'site{i}', ',',
+            ('depth', 'taxa1', 'taxa2'),
+            (10, i, 4),
+            (20, 3, i),
+            (30, 1, 1))
+        for i in range(1, 3)
+    ]
+
+    profile_path = tmp_path / 'profile.json'
+
+    main(['--jobs', str(jobs),
+        '--profile', str(profile_path),
+        '--taxas', taxas,
+        '--biomes', biomes] + sites)
+
+    with open(profile_path) as f:
+        report = json.load(f)
+
+    stages = {(r['stage'], r['site']): r for r in report['stages']}
+
+    assert 'build_biomization' in report['totals']
+    for site in sites:
+        for name in ('read_csv', 'get_stabilized', 'get_biome_affinity', 'write_biomes', 'process_site'):
+            record = stages[(name, site)]
+            assert record['rows'] == 3
+            assert record['wall_time'] >= 0
+            assert 'allocated_bytes' in record
+
+
+@SEPS
+@pytest.mark.parametrize('depths', [(10, 20, 30, 40), (10.5, 20, 30, 40.25)])
+def test_incremental_adds_new_samples_sorted_by_index(tmp_path, sep, depths):
+    taxas = write_taxas(tmp_path, sep)
+    biomes = write_biomes(tmp_path, sep)
+
+    header = ('depth', 'taxa1', 'taxa2', 'taxa3')
+    rows = [(depth,) + values for depth, values in zip(depths, [(1, 4, 45), (3, 0, 7), (5, 5, 5), (0, 0, 0)])]
+
+    def run(*options):
+        main(['--separator', sep,
+            '--save-percentages',
+            '--save-stabilized',
+            '--top-biomes', '2',
+            '--taxas', taxas,
+            '--biomes', biomes] + list(options) + [str(tmp_path / 'site1.csv')])
+
+        return {
+            name: read_csv(tmp_path / f'site1_{name}.csv')
+            for name in ('percentages', 'stabilized', 'scores', 'biomes', 'top_biomes')
+        }
+
+    write_samples(tmp_path, 'site1', sep, header, *rows)
+    full = run()
+
+    # Add new samples both before and after the existing ones
+    write_samples(tmp_path, 'site1', sep, header, rows[3], rows[1])
+    run()
+    write_samples(tmp_path, 'site1', sep, header, rows[1], rows[3], rows[2], rows[0])
+    assert run('--incremental') == full
+
+    # Existing samples are not calculated again
+    with open(tmp_path / 'site1_biomes.csv', 'wt') as f:
+        f.write(expected_csv(sep, ('depth', 'Biome'), *[(depth, 'edited') for depth in depths]))
+    assert run('--incremental')['biomes'].count('edited') == 4
+
+
+def test_incremental_processes_site_from_scratch_when_index_type_changes(tmp_path):
+    taxas = write_taxas(tmp_path, ',')
+    biomes = write_biomes(tmp_path, ',')
+
+    site1 = write_samples(tmp_path, 'site1', ',', ('depth', 'taxa1', 'taxa2'), (10, 1, 4))
+    main(['--taxas', taxas, '--biomes', biomes, site1])
+
+    write_samples(tmp_path, 'site1', ',', ('depth', 'taxa1', 'taxa2'), (10, 1, 4), (15.5, 4, 1))
+    main(['--incremental', '--taxas', taxas, '--biomes', biomes, site1])
+
+    assert read_csv(tmp_path / 'site1_scores.csv') == expected_csv(',',
+        ('depth', 'biome1', 'biome2', 'biome3'),
+        ('10.00', '4.42', '8.92', '0.00'),
+        ('15.50', '8.92', '4.42', '0.00'))
+
+
+def test_incremental_processes_site_from_scratch_without_outputs(tmp_path, capsys):
+    taxas = write_taxas(tmp_path, ',')
+    biomes = write_biomes(tmp_path, ',')
+
+    site1 = write_samples(tmp_path, 'site1', ',',
+        ('depth', 'taxa1', 'taxa2'),
+        (10, 1, 4))
+
+    main(['--incremental', '--taxas', taxas, '--biomes', biomes, site1])
+    first = capsys.readouterr().out
+
+    assert read_csv(tmp_path / 'site1_biomes.csv') == expected_csv(',', ('depth', 'Biome'), (10, 'biome2'))
+    assert 'Wrote biomes to:' in first
+
+    # Outputs that haven't been saved before also require processing the whole site
+    main(['--incremental', '--save-stabilized', '--taxas', taxas, '--biomes', biomes, site1])
+    assert 'Wrote stabilized to:' in capsys.readouterr().out
+
+    main(['--incremental', '--save-stabilized', '--taxas', taxas, '--biomes', biomes, site1])
+    assert 'No new samples in:' in capsys.readouterr().out
+
+
+def test_incremental_requires_csv_output(tmp_path):
+    with pytest.raises(SystemExit):
+        main(['--incremental', '--format', 'parquet', '--taxas', 'taxas.csv', '--biomes', 'biomes.csv', 'site1.csv'])
+
+
+def test_parallel_sites_give_the_same_output_as_sequential(tmp_path, capsys):
+    taxas = write_taxas(tmp_path, ',')
+    biomes = write_biomes(tmp_path, ',')
+
+    sites = [
+        write_samples(tmp_path, f'site{i}', ',',
+            ('depth', 'taxa1', 'taxa2', f'taxa{i + 3}'),
+            (10, i, 4, 45),
+            (20, 3, i, 7))
+        for i in range(1, 6)
+    ]
+
+    def run(jobs):
+        main(['--jobs', str(jobs),
+            '--save-stabilized',
+            '--taxas', taxas,
+            '--biomes', biomes] + sites)
+
+        output = capsys.readouterr().out
+        results = {
+            f'site{i}_{name}': read_csv(tmp_path / f'site{i}_{name}.csv')
+            for i in range(1, 6)
+            for name in ('stabilized', 'scores', 'biomes')
+        }
+        return output, results
+
+    sequential = run(1)
+    parallel = run(3)
+
+    assert parallel == sequential
+    assert 'taxa4\ntaxa5\ntaxa6\ntaxa7\ntaxa8\n' in parallel[0]
+
+
+def test_streaming_sites_reports_unmapped_taxas_at_the_end(tmp_path, capsys):
+    taxas = write_taxas(tmp_path, ',')
+    biomes = write_biomes(tmp_path, ',')
+
+    site1 = write_samples(tmp_path, 'site1', ',',
+        ('depth', 'taxa1', 'taxa5'),
+        (10, 1, 9))
+
+    site2 = write_samples(tmp_path, 'site2', ',',
+        ('depth', 'taxa4', 'taxa2'),
+        (20, 1, 9))
+
+    main(['--stream',
+        '--taxas', taxas,
+        '--biomes', biomes,
+        site1, site2])
+
+    output = capsys.readouterr().out
+    assert output.index('Wrote scores to:') < output.index('taxas that are not mapped')
+    assert output.endswith('taxa4\ntaxa5\n\n')
+
+    assert read_csv(tmp_path / 'site2_biomes.csv') == expected_csv(',',
+        ('depth', 'Biome'),
+        (20, 'biome2'))
+
+
 # Simple taxa mapping: taxa1/2/3 maps to PFTs 1/2/3 respectively
 # Also include taxa0 that maps to PFTs 1,2,3 to check that irregular CSV files work
 def write_taxas(tmp_path, sep):